@@ -0,0 +1,12 @@
+# benchmarks
+# Offline, CPU-only performance checks for deepgen_service_lstm.
+#
+#   python -m benchmarks                      # run micro + load, print results
+#   python -m benchmarks --save baselines/cpu.json
+#   python -m benchmarks --compare baselines/cpu.json   # exit 1 on regression
+#
+# Run from the server/ directory so the service modules are importable.
+import os
+
+# Benchmarks must never touch the on-disk state of a real deployment
+os.environ.setdefault("DEEPGEN_STATE_BACKEND", "memory")
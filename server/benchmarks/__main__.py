@@ -0,0 +1,65 @@
+# python -m benchmarks [--suite micro|load|backends|scaling|all] [--save PATH] [--compare PATH]
+import argparse
+import json
+import sys
+
+import torch
+
+from . import backends, load, micro, scaling
+from .harness import compare, load_baseline, save_baseline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmarks for deepgen_service_lstm")
+    parser.add_argument("--suite", choices=["micro", "load", "backends", "scaling", "all"], default="all")
+    parser.add_argument("--quick", action="store_true", help="fewer rounds and lengths, for smoke runs")
+    parser.add_argument("--threads", type=int, default=1, help="torch intra-op threads (default 1 for stable numbers)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--max-length", type=int, default=100)
+    parser.add_argument("--hidden-size", type=int, help="backends suite: measure a fresh SimpleLSTM of this width")
+    parser.add_argument("--max-workers", type=int, help="scaling suite: largest worker count (default: all cores)")
+    parser.add_argument("--pin-cores", action="store_true", help="scaling suite: pin each worker to its own cores")
+    parser.add_argument("--save", metavar="PATH", help="write results as a baseline JSON file")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a baseline; exit 1 on regression")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown as a fraction (default 0.25)")
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    args = parser.parse_args(argv)
+
+    torch.set_num_threads(args.threads)
+    results = {}
+    if args.suite in ("micro", "all"):
+        results.update(micro.run(quick=args.quick))
+    if args.suite in ("load", "all"):
+        requests = min(args.requests, 50) if args.quick else args.requests
+        results.update(load.run(args.concurrency, requests, args.max_length))
+    if args.suite in ("backends", "all"):
+        results.update(backends.run(quick=args.quick, hidden_size=args.hidden_size))
+    if args.suite in ("scaling", "all"):
+        requests = min(args.requests, 50) if args.quick else args.requests
+        results.update(scaling.run(args.concurrency, requests, args.max_length, args.max_workers, args.pin_cores))
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    if args.save:
+        save_baseline(args.save, results)
+        print(f"saved {len(results)} results to {args.save}")
+    if args.compare:
+        rows, regressions = compare(results, load_baseline(args.compare), args.threshold)
+        for name, base, new, change in rows:
+            flag = "REGRESSED" if name in regressions else ""
+            if base is None:
+                print(f"{name:45s} {'-':>12s} {new:12.3f}   (new)")
+            else:
+                print(f"{name:45s} {base:12.3f} {new:12.3f} {change:+8.1%} {flag}")
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}", file=sys.stderr)
+            return 1
+    elif not args.json:
+        for name, r in sorted(results.items()):
+            print(f"{name:45s} {r['value']:12.3f} {r['unit']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# backends.py
+# Latency and accuracy of each LSTM inference backend against eager fp32:
+# per-token step time at batch 1 and 16, prompt prefill time, weight memory,
+# and how far each backend's logits drift from eager over a teacher-forced
+# sequence (max |logit diff|, mean KL(eager || backend), top-1 agreement).
+#
+# By default the served model (DEEPGEN_CHECKPOINT, if set) is measured; hidden_size builds a fresh
+# SimpleLSTM of that width instead, since int8 pays off more as the matmuls
+# grow.
+import torch
+import torch.nn.functional as F
+
+import deepgen_service_lstm as svc
+from lstm_backends import BACKENDS, build_backend
+
+from .harness import result, time_per_call
+from .micro import PROMPT
+
+PREFILL_LENGTH = 120
+ACCURACY_LENGTH = 200
+
+
+def teacher_forced_logits(backend, idxs):
+    hidden = backend.zeros(1)
+    logits = []
+    for idx in idxs:
+        step_logits, hidden = backend.step(torch.tensor([idx], dtype=torch.long), hidden)
+        logits.append(step_logits[0])
+    return torch.stack(logits)
+
+
+def accuracy(reference, logits):
+    log_p, log_q = F.log_softmax(reference, dim=-1), F.log_softmax(logits, dim=-1)
+    return {
+        "max_logit_diff": (reference - logits).abs().max().item(),
+        "kl": max(0.0, F.kl_div(log_q, log_p, log_target=True, reduction="batchmean").item()),
+        "top1_agreement": (reference.argmax(-1) == logits.argmax(-1)).float().mean().item(),
+    }
+
+
+def bench_backend(backend, prefix, quick=False):
+    repeat = 3 if quick else 5
+    prompt = (svc.encode_prompt(PROMPT) * 2)[:PREFILL_LENGTH]
+    out = {}
+    for batch_size in (1, 16):
+        idx = torch.tensor(prompt[:batch_size], dtype=torch.long)
+        hidden = backend.zeros(batch_size)
+        us = time_per_call(lambda: backend.step(idx, hidden), repeat=repeat)
+        out[f"{prefix}.step.b{batch_size}"] = result(us, "us")
+        out[f"{prefix}.step.b{batch_size}.tokens_per_s"] = result(batch_size / (us / 1e6), "tok/s", higher_is_better=True)
+    hidden = backend.zeros(1)
+    out[f"{prefix}.prefill.len{PREFILL_LENGTH}"] = result(time_per_call(lambda: backend.prefill([prompt], hidden), repeat=repeat), "us")
+    out[f"{prefix}.weights"] = result(backend.weight_bytes() / 1024, "KiB")
+    return out
+
+
+def run(quick=False, hidden_size=None):
+    torch.manual_seed(0)
+    model = svc.get_model() if hidden_size is None else svc.SimpleLSTM(svc.tokenizer.size, hidden_size).eval()
+    width = model.lstm.hidden_size
+    idxs = (svc.encode_prompt(PROMPT) * 4)[:ACCURACY_LENGTH // 4 if quick else ACCURACY_LENGTH]
+    results, reference = {}, None
+    with torch.inference_mode():
+        for name in BACKENDS:
+            backend = build_backend(model, name)
+            prefix = f"backend.{name}.h{width}"
+            results.update(bench_backend(backend, prefix, quick))
+            logits = teacher_forced_logits(backend, idxs)
+            if reference is None:
+                reference = logits
+                continue
+            acc = accuracy(reference, logits)
+            results[f"{prefix}.max_logit_diff"] = result(acc["max_logit_diff"], "logit")
+            results[f"{prefix}.kl"] = result(acc["kl"] * 1e6, "micro-nats")
+            results[f"{prefix}.top1_agreement"] = result(acc["top1_agreement"] * 100, "%", higher_is_better=True)
+    return results
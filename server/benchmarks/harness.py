@@ -0,0 +1,93 @@
+# harness.py
+# Timing helpers and the JSON baseline format shared by the benchmark suites.
+#
+# A result is {"value": float, "unit": str, "higher_is_better": bool}. A
+# baseline file is {"meta": {...}, "results": {name: result}}; a result is a
+# regression when it is worse than the baseline by more than the threshold
+# (a fraction, e.g. 0.25 = 25%).
+import json
+import os
+import platform
+import statistics
+import time
+
+
+def result(value, unit, higher_is_better=False):
+    return {"value": round(float(value), 3), "unit": unit, "higher_is_better": higher_is_better}
+
+
+def time_per_call(fn, repeat=5, min_time=0.2):
+    """Median microseconds per call of fn() over `repeat` rounds, each round
+    running enough calls to last at least min_time seconds."""
+    fn()  # warm-up
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 4 or number >= 1 << 20:
+            break
+        number *= 2
+    number = max(1, int(number * (min_time / max(elapsed, 1e-9))))
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - start) / number)
+    return statistics.median(rounds) * 1e6
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def environment():
+    import torch
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def save_baseline(path, results):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"meta": environment(), "results": results}, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def load_baseline(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(results, baseline, threshold=0.25):
+    """Returns a list of (name, base, new, change) rows and the regressed names."""
+    rows, regressions = [], []
+    for name, new in sorted(results.items()):
+        base = baseline["results"].get(name)
+        if base is None:
+            rows.append((name, None, new["value"], None))
+            continue
+        if not base["value"]:
+            # e.g. an error count that used to be zero: any increase regresses
+            if new["value"] > 0 and not new["higher_is_better"]:
+                regressions.append(name)
+            rows.append((name, base["value"], new["value"], 0.0 if not new["value"] else float("inf")))
+            continue
+        change = (new["value"] - base["value"]) / base["value"]
+        worse = -change if new["higher_is_better"] else change
+        if worse > threshold:
+            regressions.append(name)
+        rows.append((name, base["value"], new["value"], change))
+    return rows, regressions
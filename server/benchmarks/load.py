@@ -0,0 +1,66 @@
+# load.py
+# In-process load generator: drives the FastAPI app through httpx's ASGI
+# transport (no sockets, no server process) with a fixed number of concurrent
+# clients and reports throughput and latency percentiles.
+import asyncio
+import random
+import time
+
+import httpx
+
+import deepgen_service_lstm as svc
+
+from .harness import percentile, result
+
+PROMPTS = [
+    "I'm so happy to see you again!",
+    "Why are you always so mad at me?",
+    "I feel sad and I can't stop the tears.",
+    "I'm scared of what's out there in the dark.",
+    "Tell me about your day.",
+]
+PERSONALITIES = ["kind", "sarcastic", "brave youthful", "loyal funny", None]
+
+
+def make_payload(i, max_length):
+    rng = random.Random(i)
+    return {
+        "prompt": rng.choice(PROMPTS),
+        "personality": rng.choice(PERSONALITIES),
+        "backstory": "Raised in a lighthouse by the sea.",
+        "user_id": f"load-user-{i % 50}",
+        "character_id": f"load-char-{i % 7}",
+        "max_length": max_length,
+    }
+
+
+async def drive(concurrency=16, requests=200, max_length=100, path="/generate"):
+    latencies = []
+    statuses = {}
+    counter = iter(range(requests))
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=svc.app), base_url="http://bench", timeout=None) as client:
+        async def worker():
+            for i in counter:
+                start = time.perf_counter()
+                resp = await client.post(path, json=make_payload(i, max_length))
+                latencies.append(time.perf_counter() - start)
+                statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, statuses, elapsed
+
+
+def run(concurrency=16, requests=200, max_length=100):
+    latencies, statuses, elapsed = asyncio.run(drive(concurrency, requests, max_length))
+    ms = [s * 1000 for s in latencies]
+    prefix = f"load.c{concurrency}.len{max_length}"
+    return {
+        f"{prefix}.throughput": result(len(latencies) / elapsed, "req/s", higher_is_better=True),
+        f"{prefix}.p50": result(percentile(ms, 50), "ms"),
+        f"{prefix}.p95": result(percentile(ms, 95), "ms"),
+        f"{prefix}.p99": result(percentile(ms, 99), "ms"),
+        f"{prefix}.errors": result(sum(n for code, n in statuses.items() if code != 200), "count"),
+    }
@@ -0,0 +1,90 @@
+# micro.py
+# Microbenchmarks for the hot paths of deepgen_service_lstm: the LSTM sampling
+# loop (unbatched and batched), the tokenizer, emotion detection and the
+# behavior tree, the text stylers and the whole rule-based stage.
+from concurrent.futures import wait
+
+import torch
+
+import deepgen_service_lstm as svc
+from lstm_sampling import SamplingParams
+from text_styling import compile_profile, style_dialogue
+
+from .harness import result, time_per_call
+
+PROMPT = "(leans forward, eyes narrowed) I'm here for you. It's okay to feel sad sometimes. The floor creaks beneath cautious footsteps."
+LSTM_LENGTHS = (10, 100, 500)
+
+
+def bench_sample_lstm(quick=False):
+    out = {}
+    for max_length in LSTM_LENGTHS[:2] if quick else LSTM_LENGTHS:
+        us = time_per_call(lambda: svc.sample_lstm(PROMPT, max_length), repeat=3 if quick else 5)
+        out[f"sample_lstm.len{max_length}"] = result(us, "us")
+        out[f"sample_lstm.len{max_length}.tokens_per_s"] = result(max_length / (us / 1e6), "tok/s", higher_is_better=True)
+    for name, params in (("greedy", SamplingParams(greedy=True)), ("top_k", SamplingParams(top_k=5)), ("top_p", SamplingParams(top_p=0.9))):
+        us = time_per_call(lambda: svc.sample_lstm(PROMPT, 100, params), repeat=3 if quick else 5)
+        out[f"sample_lstm.len100.{name}"] = result(us, "us")
+    return out
+
+
+def bench_tokenizer(quick=False):
+    # Long prompts cost no more than a context window's worth of encoding and prefill
+    out = {}
+    for name, text in (("3kb", PROMPT * 25), ("1mb", PROMPT * 8500)):
+        out[f"tokenizer.encode.{name}"] = result(time_per_call(lambda: svc.encode_prompt(text)), "us")
+    idxs = svc.encode_prompt(PROMPT * 25)
+    out["tokenizer.decode.3kb"] = result(time_per_call(lambda: svc.decode_idxs(idxs)), "us")
+    us = time_per_call(lambda: svc.sample_lstm(PROMPT * 8500, 10), repeat=3 if quick else 5)
+    out["sample_lstm.prompt1mb.len10"] = result(us, "us")
+    return out
+
+
+def bench_batched_lstm(batch_size=16, max_length=100):
+    idxs = svc.encode_prompt(PROMPT)
+
+    def run():
+        futures = [svc.get_batcher().submit(idxs, max_length) for _ in range(batch_size)]
+        wait(futures)
+
+    us = time_per_call(run, repeat=3, min_time=0.5)
+    return {
+        f"batcher.b{batch_size}.len{max_length}": result(us, "us"),
+        f"batcher.b{batch_size}.len{max_length}.tokens_per_s": result(batch_size * max_length / (us / 1e6), "tok/s", higher_is_better=True),
+    }
+
+
+def bench_rule_based():
+    prompt = "I was so scared and nervous, then furious about the whole thing"
+    out = {
+        "emotion.detect": result(time_per_call(lambda: svc.emotion_fsm.detect(prompt)), "us"),
+        "behavior_tree": result(time_per_call(lambda: svc.behavior_tree(
+            "kind, brave", "afraid", "reassure", prompt, "justice", "loyalty", "A long backstory", "A description")), "us"),
+    }
+    req = svc.GenerateRequest(prompt=prompt, personality="youthful sarcastic funny", backstory="Grew up by the sea",
+                              user_id="bench-user", character_id="bench-char", feedback="positive")
+    out["compose_response"] = result(time_per_call(lambda: svc.compose_response(req.model_copy())), "us")
+    return out
+
+
+def bench_stylers():
+    profile = compile_profile("youthful sarcastic funny shy", "pirate", "sad")
+    short = "Hello my friend, this is really amazing and cool, not sure what to say."
+    long_text = short * 40
+    return {
+        "style.compile_profile.cached": result(time_per_call(lambda: compile_profile("youthful sarcastic", "pirate", "sad")), "us"),
+        "style.dialogue.short": result(time_per_call(lambda: style_dialogue(short, profile, "Backstory: x")), "us"),
+        "style.transform.3kb": result(time_per_call(lambda: profile.transform(long_text)), "us"),
+    }
+
+
+def run(quick=False):
+    torch.manual_seed(0)
+    results = {}
+    results.update(bench_sample_lstm(quick))
+    results.update(bench_tokenizer(quick))
+    if svc.MAX_BATCH_SIZE > 1:
+        results.update(bench_batched_lstm())
+    results.update(bench_rule_based())
+    results.update(bench_stylers())
+    return results
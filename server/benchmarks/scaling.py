@@ -0,0 +1,175 @@
+# scaling.py
+# Worker scaling on one host: starts `python prefork.py --workers N` for
+# growing N, drives it over real HTTP with the load suite's payloads, and
+# reports throughput and the total memory of the server processes. Memory is
+# the sum of PSS (proportional set size), which splits shared pages such as the
+# forked weights between the processes that map them, so it grows only by each
+# worker's private memory.
+#
+# check_forked_threads is a regression check for the fork itself: from a
+# parent whose torch thread pool is multi-threaded (as on any multi-core host),
+# a forked worker with its own thread budget must still generate with every
+# backend. Its .errors results count workers that failed or hung, e.g. on a
+# GNU OpenMP pool inherited across fork().
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from .harness import percentile, result
+from .load import make_payload
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def worker_counts(max_workers=None):
+    cores = max_workers or os.cpu_count() or 1
+    counts, n = [], 1
+    while n < cores:
+        counts.append(n)
+        n *= 2
+    return counts + [cores]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_tree(pid):
+    pids = [pid]
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/task/{p}/children") as f:
+                pids.extend(int(c) for c in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def pss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+    return total
+
+
+def wait_ready(base_url, workers, timeout=120.0):
+    # Every worker answers /readyz on its own; keep asking until enough 200s
+    # in a row make it likely all of them have warmed up
+    deadline = time.monotonic() + timeout
+    ok = 0
+    while time.monotonic() < deadline:
+        try:
+            ok = ok + 1 if httpx.get(f"{base_url}/readyz", timeout=2.0).status_code == 200 else 0
+        except httpx.HTTPError:
+            ok = 0
+        if ok >= 4 * workers:
+            return
+        time.sleep(0.05 if ok else 0.25)
+    raise TimeoutError(f"server at {base_url} not ready after {timeout:.0f}s")
+
+
+async def drive(base_url, concurrency, requests, max_length):
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=0)
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                start = time.perf_counter()
+                resp = await client.post("/generate", json=make_payload(i, max_length))
+                latencies.append(time.perf_counter() - start)
+                errors += resp.status_code != 200
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def forked_generation(backend, parent_threads, intra):
+    # What prefork does, from a parent with a multi-threaded pool (torch's
+    # default on a multi-core host): preload, fork, set the worker's thread
+    # budget, generate on the worker's main thread
+    import torch
+    torch.set_num_threads(parent_threads)
+    os.environ["DEEPGEN_LSTM_BACKEND"] = backend
+    import prefork
+    model, backend = prefork.preload()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            prefork.configure_threads(intra, 1)
+            import deepgen_service_lstm as svc
+            svc.install_model(model, backend)
+            svc.sample_lstm("warm up", 50)
+            code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    sys.exit(os.waitstatus_to_exitcode(status))
+
+
+def check_forked_threads(backends=("eager", "int8", "torchscript"), parent_threads=4, intra=2, timeout=60.0):
+    results = {}
+    env = dict(os.environ, DEEPGEN_STATE_BACKEND="memory", DEEPGEN_WARMUP="0")
+    for backend in backends:
+        code = (f"from benchmarks.scaling import forked_generation; "
+                f"forked_generation({backend!r}, {int(parent_threads)}, {int(intra)})")
+        # A new session, so a hung worker can be killed along with its parent
+        proc = subprocess.Popen([sys.executable, "-c", code], cwd=SERVER_DIR, env=env, start_new_session=True)
+        try:
+            failed = proc.wait(timeout=timeout) != 0
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            failed = True
+        results[f"scaling.forked_threads.{backend}.errors"] = result(int(failed), "count")
+    return results
+
+
+def bench_workers(workers, concurrency, requests, max_length, pin_cores=False):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, DEEPGEN_STATE_BACKEND="memory")
+    cmd = [sys.executable, "prefork.py", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers)]
+    server = subprocess.Popen(cmd + (["--pin-cores"] if pin_cores else []), cwd=SERVER_DIR, env=env)
+    try:
+        wait_ready(base_url, workers)
+        latencies, errors, elapsed = asyncio.run(drive(base_url, concurrency, requests, max_length))
+        memory = pss_bytes(process_tree(server.pid))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    ms = [s * 1000 for s in latencies]
+    prefix = f"scaling.w{workers}"
+    return {
+        f"{prefix}.throughput": result(len(latencies) / elapsed, "req/s", higher_is_better=True),
+        f"{prefix}.p95": result(percentile(ms, 95), "ms"),
+        f"{prefix}.errors": result(errors, "count"),
+        f"{prefix}.memory": result(memory / (1024 * 1024), "MiB"),
+    }
+
+
+def run(concurrency=16, requests=200, max_length=100, max_workers=None, pin_cores=False):
+    results = check_forked_threads()
+    for workers in worker_counts(max_workers):
+        results.update(bench_workers(workers, concurrency, requests, max_length, pin_cores))
+    return results
@@ -0,0 +1,122 @@
+# character_profiles.py
+# Server-side registry of character profiles.
+#
+# A client registers a character once (PUT /characters/{id}) and afterwards
+# sends only its character_id. The raw fields live in the state store under
+# the "character" namespace (kept out of the state TTL), so every worker sees
+# registrations and updates. Each worker compiles a profile once into a
+# CompiledCharacter holding everything the hot path derives from it: the trait
+# flags behavior_tree branches on, the static context lines and the styling
+# traits. Compiled profiles sit in a bounded LRU keyed by character_id and
+# checked against the stored version, a digest of the fields, so an update
+# made by any worker is picked up on the next request.
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from text_styling import personality_traits
+
+PROFILE_FIELDS = ("backstory", "description", "personality", "motivations", "values", "accent")
+
+
+def behavior_flags(personality=None, motivations=None, values=None):
+    # The personality/value checks behavior_tree makes, in its own terms
+    personality = (personality or "").lower()
+    motivations = (motivations or "").lower()
+    values = (values or "").lower()
+    flags = set()
+    if "sarcastic" in personality:
+        flags.add("sarcastic")
+    if "kind" in personality:
+        flags.add("kind")
+    if "brave" in personality or "courage" in values:
+        flags.add("brave")
+    if "loyal" in personality or "loyalty" in values:
+        flags.add("loyal")
+    if "justice" in motivations or "justice" in values:
+        flags.add("justice")
+    return frozenset(flags)
+
+
+def context_lines(backstory=None, description=None, personality=None, motivations=None, values=None, accent=None):
+    lines = []
+    if backstory:
+        lines.append(f"Backstory: {backstory}")
+    if description:
+        lines.append(f"Description: {description}")
+    if personality:
+        lines.append(f"Personality: {personality}")
+    if motivations:
+        lines.append(f"Motivations: {motivations}")
+    if values:
+        lines.append(f"Values: {values}")
+    return lines
+
+
+def profile_version(fields):
+    return hashlib.blake2b(json.dumps(fields, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+class CompiledCharacter:
+    __slots__ = ("fields", "version", "flags", "context", "traits")
+
+    def __init__(self, fields, version=None):
+        # version is set for registered profiles only
+        self.fields = {name: fields.get(name) for name in PROFILE_FIELDS}
+        self.version = version
+        self.flags = behavior_flags(fields.get("personality"), fields.get("motivations"), fields.get("values"))
+        self.context = tuple(context_lines(**self.fields))
+        self.traits = personality_traits(fields.get("personality"))
+
+
+class CharacterRegistry:
+    namespace = "character"
+
+    def __init__(self, cache_size=1024):
+        self.cache_size = max(1, int(cache_size))
+        self._compiled = OrderedDict()  # character_id -> CompiledCharacter
+        self._lock = threading.Lock()
+        self.compiles = 0
+
+    def key(self, character_id):
+        return (self.namespace, character_id)
+
+    def stored(self, state, character_id):
+        """The registered {"fields", "version"} document, or None."""
+        return state.get(self.namespace, character_id) if character_id else None
+
+    def get(self, state, character_id):
+        """The compiled profile registered for character_id, or None."""
+        doc = self.stored(state, character_id)
+        if doc is None:
+            return None
+        with self._lock:
+            compiled = self._compiled.get(character_id)
+            if compiled is not None and compiled.version == doc["version"]:
+                self._compiled.move_to_end(character_id)
+                return compiled
+        return self._remember(character_id, CompiledCharacter(doc["fields"], doc["version"]))
+
+    def put(self, state, character_id, fields):
+        fields = {name: fields.get(name) for name in PROFILE_FIELDS}
+        compiled = CompiledCharacter(fields, profile_version(fields))
+        state.set(self.namespace, character_id, {"fields": compiled.fields, "version": compiled.version})
+        return self._remember(character_id, compiled)
+
+    def delete(self, state, character_id):
+        state.set(self.namespace, character_id, None)
+        with self._lock:
+            self._compiled.pop(character_id, None)
+
+    def _remember(self, character_id, compiled):
+        with self._lock:
+            self.compiles += 1
+            self._compiled[character_id] = compiled
+            self._compiled.move_to_end(character_id)
+            while len(self._compiled) > self.cache_size:
+                self._compiled.popitem(last=False)
+        return compiled
+
+    def stats(self):
+        return {"compiled": len(self._compiled), "cache_size": self.cache_size, "compiles": self.compiles}
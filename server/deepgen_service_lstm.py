@@ -1,15 +1,45 @@
 # deepgen_service_lstm.py
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from fastapi.middleware.cors import CORSMiddleware
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
 import random
 import time
+import os
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
-app = FastAPI()
+from lstm_backends import BackendRegistry, backend_name
+from lstm_model import SimpleLSTM, load_model
+from tokenizer import get_tokenizer
+from lstm_batching import LSTMBatcher
+from generation_pool import GenerationPool, QueueFull
+from generation_budget import request_budget
+from lstm_state_cache import HiddenStateCache
+from lstm_sampling import BatchParams, SamplingParams, sample_next
+from state_store import open_state_store
+from keyword_matcher import KeywordMatcher
+from text_styling import compile_profile, style_dialogue
+from response_cache import ResponseCache
+from character_profiles import PROFILE_FIELDS, CharacterRegistry, CompiledCharacter, behavior_flags
+from relationship_graph import RelationshipGraph
+from memory_index import MemoryIndex
+from metrics import Registry, StageTimer
+
+@asynccontextmanager
+async def lifespan(app):
+    # Load and warm the model in the background, so /healthz answers at once
+    # and /readyz turns 200 only when generation is fast
+    if WARMUP_ENABLED:
+        asyncio.get_running_loop().run_in_executor(None, warm_up)
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,48 +48,287 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Dummy vocabulary and model for demonstration
-VOCAB = list("abcdefghijklmnopqrstuvwxyz .,!?\n")
-CHAR2IDX = {c: i for i, c in enumerate(VOCAB)}
-IDX2CHAR = {i: c for i, c in enumerate(VOCAB)}
-VOCAB_SIZE = len(VOCAB)
-
-class SimpleLSTM(nn.Module):
-    def __init__(self, vocab_size, hidden_size=128, num_layers=1):
-        super().__init__()
-        self.embed = nn.Embedding(vocab_size, hidden_size)
-        self.lstm = nn.LSTM(hidden_size, hidden_size, num_layers, batch_first=True)
-        self.fc = nn.Linear(hidden_size, vocab_size)
-
-    def forward(self, x, hidden=None):
-        x = self.embed(x)
-        out, hidden = self.lstm(x, hidden)
-        out = self.fc(out)
-        return out, hidden
-
-# Instantiate a dummy model (not trained)
-model = SimpleLSTM(VOCAB_SIZE)
-model.eval()
-
-def sample_lstm(prompt, max_length=100, temperature=1.0):
-    # Convert prompt to indices
-    input_idxs = [CHAR2IDX.get(c, 0) for c in prompt.lower() if c in CHAR2IDX]
+# Tokenizer: "char" (the model's character vocabulary) or "byte" (UTF-8 bytes,
+# nothing dropped); the checkpoint must have been trained on the same vocabulary.
+# Prompts are cut to their trailing DEEPGEN_CONTEXT_WINDOW tokens (0 = no limit),
+# which bounds encode and prefill time for very long prompts.
+tokenizer = get_tokenizer(os.environ.get("DEEPGEN_TOKENIZER", "char"))
+CONTEXT_WINDOW = int(os.environ.get("DEEPGEN_CONTEXT_WINDOW", "512"))
+
+# Model, loaded on first use (or by the startup warm-up) from DEEPGEN_CHECKPOINT;
+# without a checkpoint a randomly initialised demo model is used
+CHECKPOINT_PATH = os.environ.get("DEEPGEN_CHECKPOINT")
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_model(CHECKPOINT_PATH, tokenizer.vocab)
+    return _model
+
+def install_model(model, backend=None):
+    # Serve a model (and optionally a backend built from it) loaded elsewhere,
+    # e.g. by the prefork parent that shares them with every worker
+    global _model
+    with _model_lock:
+        _model = model
+    if backend is not None:
+        lstm_backends.install(backend)
+
+# Inference backends (eager fp32, int8, torchscript), built from the model on
+# first use. DEEPGEN_LSTM_BACKEND picks the default; a request can name one
+# through its model field, e.g. "lstm-int8".
+lstm_backends = BackendRegistry(get_model, default=os.environ.get("DEEPGEN_LSTM_BACKEND", "eager"))
+
+# Micro-batching: concurrent generations share one LSTM step per token.
+# DEEPGEN_MAX_BATCH_SIZE=1 falls back to the per-request sample_lstm loop.
+MAX_BATCH_SIZE = int(os.environ.get("DEEPGEN_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.environ.get("DEEPGEN_MAX_WAIT_MS", "5"))
+# Per-conversation hidden states, so each turn only prefills its own new text
+lstm_state_cache = HiddenStateCache(
+    max_bytes=int(float(os.environ.get("DEEPGEN_STATE_CACHE_MB", "64")) * 1024 * 1024),
+    ttl_seconds=float(os.environ.get("DEEPGEN_STATE_CACHE_TTL", "1800")),
+)
+# One batcher per backend. Hidden states have the same shape and meaning on
+# every backend, so a conversation keeps its cached state if it switches.
+lstm_batchers = {}
+_batchers_lock = threading.Lock()
+
+def get_batcher(backend=None):
+    name = lstm_backends.get(backend).name
+    batcher = lstm_batchers.get(name)
+    if batcher is None:
+        with _batchers_lock:
+            batcher = lstm_batchers.get(name)
+            if batcher is None:
+                batcher = lstm_batchers[name] = LSTMBatcher(lstm_backends.get(name), max_batch_size=MAX_BATCH_SIZE,
+                                                            max_wait_ms=MAX_WAIT_MS, state_cache=lstm_state_cache)
+    return batcher
+
+# Server-wide limits on one LSTM continuation: requests asking for more than
+# DEEPGEN_MAX_LENGTH characters get that many, and sampling stops after
+# DEEPGEN_MAX_GENERATION_SECONDS (0 = no limit) from the request's arrival, or
+# sooner if the request sets timeout_ms. Generation also stops when the client
+# disconnects. A continuation cut short is returned as far as it got, with the
+# reason in lstm_finish_reason.
+MAX_LENGTH = int(os.environ.get("DEEPGEN_MAX_LENGTH", "1000"))
+MAX_GENERATION_SECONDS = float(os.environ.get("DEEPGEN_MAX_GENERATION_SECONDS", "30"))
+
+def generation_budget(req):
+    return request_budget(req.timeout_ms, MAX_GENERATION_SECONDS)
+
+def generation_length(req):
+    # (characters to sample, whether the server limit cut the request down)
+    requested = max(0, req.max_length or 100)
+    if MAX_LENGTH > 0 and requested > MAX_LENGTH:
+        return MAX_LENGTH, True
+    return requested, False
+
+def finish_reason(sampled, max_length, capped, budget):
+    if sampled < max_length:
+        # A process worker cannot record why it stopped; only its deadline can stop it
+        return (budget.reason if budget is not None else None) or "deadline"
+    return "max_length" if capped else "length"
+
+async def cancel_on_disconnect(request, budgets):
+    # Waits for the client to go away (the server reports http.disconnect once
+    # the body has been read) and stops the request's generations
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+    for budget in budgets:
+        budget.cancel("disconnected")
+
+@asynccontextmanager
+async def stop_on_disconnect(request, *budgets):
+    watcher = asyncio.ensure_future(cancel_on_disconnect(request, budgets))
+    try:
+        yield
+    finally:
+        watcher.cancel()
+
+# Worker pool for unbatched generation, with bounded admission (503 + Retry-After when full)
+generation_pool = GenerationPool(
+    kind=os.environ.get("DEEPGEN_POOL", "thread"),
+    workers=int(os.environ.get("DEEPGEN_POOL_WORKERS", "0")) or None,
+    max_pending=int(os.environ.get("DEEPGEN_MAX_PENDING", "64")),
+)
+
+# Deterministic (seeded or greedy) LSTM continuations, keyed by their inputs
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get("DEEPGEN_RESPONSE_CACHE_SIZE", "4096")),
+    ttl_seconds=float(os.environ.get("DEEPGEN_RESPONSE_CACHE_TTL", "3600")),
+)
+
+def encode_prompt(prompt, rng=random):
+    # Convert prompt to indices (its trailing CONTEXT_WINDOW tokens)
+    input_idxs = tokenizer.encode(prompt, CONTEXT_WINDOW)
     if not input_idxs:
-        input_idxs = [random.randint(0, VOCAB_SIZE-1)]
-    input_tensor = torch.tensor([input_idxs], dtype=torch.long)
-    generated = input_idxs.copy()
+        input_idxs = [rng.randint(0, tokenizer.size-1)]
+    return input_idxs
+
+def decode_idxs(idxs):
+    return tokenizer.decode(idxs)
+
+def conversation_key(req):
+    if req.user_id and req.character_id:
+        return (req.user_id, req.character_id)
+    return None
+
+def lstm_backend(req):
+    # "lstm" -> default backend, "lstm-int8" -> int8, ...; None for non-LSTM models
+    name = (req.model or "").strip().lower()
+    if name == "lstm":
+        return lstm_backends.default
+    if name.startswith("lstm-"):
+        try:
+            return backend_name(name[5:])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return None
+
+def sampling_params(req):
+    try:
+        return SamplingParams(req.temperature, top_k=req.top_k, top_p=req.top_p, greedy=req.greedy)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def request_rng(req):
+    # A private RNG for a seeded request's rule-based picks; unseeded requests share `random`
+    return random.Random(req.seed) if req.seed is not None else random
+
+async def generate_lstm(input_idxs, max_length=100, params=None, state_key=None, backend=None, seed=None, budget=None):
+    # Returns the sampled indices that follow the encoded prompt; fewer than
+    # max_length if `budget` ran out first
+    params = params or SamplingParams()
+    if MAX_BATCH_SIZE <= 1 or unbatched(params, seed):
+        # Process workers cannot see this process's state cache
+        if generation_pool.kind != "thread":
+            state_key = None
+        return await generation_pool.run(sample_lstm_idxs, input_idxs, max_length, params, state_key, backend, seed, budget)
+    idxs = await asyncio.wrap_future(get_batcher(backend).submit(input_idxs, max_length, params, state_key=state_key, budget=budget))
+    return idxs[len(input_idxs):]
+
+def unbatched(params, seed):
+    # Deterministic runs (seeded or greedy) skip the batcher, whose output
+    # depends on the other rows: a shared draw ties a seeded run to its batch,
+    # and int8's dynamic activation quantization is computed over the whole
+    # batch, so even greedy picks can change with the company
+    return seed is not None or params.greedy
+
+async def stream_lstm(prompt, max_length=100, params=None, state_key=None, backend=None, seed=None, budget=None):
+    # Yields text chunks as the sampling loop produces them. Characters sampled
+    # between two reads of the queue are coalesced into one chunk. If the
+    # consumer stops early (the client disconnected), `budget` is cancelled so
+    # the sampling loop stops too.
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    input_idxs = encode_prompt(prompt, random.Random(seed) if seed is not None else random)
+    params = params or SamplingParams()
+    decode = tokenizer.stream_decoder()
+
+    def push(text):
+        if text:
+            loop.call_soon_threadsafe(chunks.put_nowait, text)
+
+    def drive():
+        for ch in iter_sample_lstm(input_idxs, max_length, params, state_key, backend, seed, budget):
+            push(ch)
+
+    if MAX_BATCH_SIZE > 1 and not unbatched(params, seed):
+        job = asyncio.wrap_future(get_batcher(backend).submit(input_idxs, max_length, params, on_token=lambda idx: push(decode(idx)),
+                                                              state_key=state_key, budget=budget))
+    elif generation_pool.kind == "thread":
+        job = asyncio.ensure_future(generation_pool.run(drive))
+    else:
+        # A process worker cannot call back into this loop; send its output in one chunk
+        async def whole():
+            idxs = await generation_pool.run(sample_lstm_idxs, input_idxs, max_length, params, None, backend, seed, budget)
+            if len(idxs) < max_length and budget is not None:
+                budget.cancel("deadline")  # the worker's copy of the budget ran out
+            push(decode_idxs(idxs))
+        job = asyncio.ensure_future(whole())
+    job.add_done_callback(lambda _: chunks.put_nowait(None))
+    try:
+        while True:
+            text = await chunks.get()
+            if text is None:
+                break
+            parts = [text]
+            while not chunks.empty():
+                nxt = chunks.get_nowait()
+                if nxt is None:
+                    chunks.put_nowait(None)
+                    break
+                parts.append(nxt)
+            yield ''.join(parts)
+    finally:
+        if not job.done() and budget is not None:
+            budget.cancel("disconnected")
+            record_finish("disconnected")
+    await job
+
+def decode_steps(input_idxs, out, params, state_key=None, backend=None, generator=None, budget=None):
+    # Core decoding loop. Writes each sampled index into the preallocated
+    # buffer `out` and yields the step number; nothing is copied out of torch
+    # per token, so callers that only need the final text decode it in bulk.
+    # `generator` (a torch.Generator) makes the draws reproducible. Stops
+    # before filling `out` once `budget` is exhausted.
+    if budget is not None and budget.exhausted():
+        return
+    backend = lstm_backends.get(backend)
     hidden = None
-    for _ in range(max_length):
-        out, hidden = model(input_tensor, hidden)
-        logits = out[0, -1] / temperature
-        probs = F.softmax(logits, dim=0).detach().numpy()
-        idx = int(np.random.choice(len(probs), p=probs/probs.sum()))
-        generated.append(idx)
-        input_tensor = torch.tensor([[idx]], dtype=torch.long)
-    return ''.join(IDX2CHAR[i] for i in generated)
+    cached = lstm_state_cache.get(state_key)
+    if cached is not None:
+        # Resume the conversation: feed the previous turn's last sample, then the new text
+        h, c, last_idx = cached
+        hidden = (h, c)
+        input_idxs = [last_idx] + list(input_idxs)
+    batch_params = BatchParams.stack([params])
+    with torch.inference_mode():
+        if out.shape[0]:
+            # Prefill all but the last prompt character, which seeds the step loop
+            if hidden is None:
+                hidden = backend.zeros(1)
+            if len(input_idxs) > 1:
+                hidden = backend.prefill([input_idxs[:-1]], hidden)
+            idx = torch.tensor([input_idxs[-1]], dtype=torch.long)
+        steps = 0
+        for i in range(out.shape[0]):
+            if budget is not None and budget.exhausted():
+                break
+            logits, hidden = backend.step(idx, hidden)
+            idx = sample_next(logits, batch_params, generator)
+            out[i] = idx[0]
+            steps = i + 1
+            yield i
+        if steps and state_key is not None:
+            lstm_state_cache.put(state_key, hidden[0], hidden[1], int(out[steps - 1]))
+
+def seeded_generator(seed):
+    return torch.Generator().manual_seed(seed & 0xFFFFFFFFFFFFFFFF) if seed is not None else None
 
-import numpy as np
+def iter_sample_lstm(input_idxs, max_length=100, params=None, state_key=None, backend=None, seed=None, budget=None):
+    # Generator version of the sampling loop: yields each new character as soon as it is sampled
+    out = torch.empty(max(0, max_length), dtype=torch.long)
+    decode = tokenizer.stream_decoder()
+    for i in decode_steps(input_idxs, out, params or SamplingParams(), state_key, backend, seeded_generator(seed), budget):
+        text = decode(int(out[i]))
+        if text:
+            yield text
 
+def sample_lstm_idxs(input_idxs, max_length=100, params=None, state_key=None, backend=None, seed=None, budget=None):
+    out = torch.empty(max(0, max_length), dtype=torch.long)
+    steps = 0
+    for i in decode_steps(input_idxs, out, params or SamplingParams(), state_key, backend, seeded_generator(seed), budget):
+        steps = i + 1
+    return out[:steps].tolist()
+
+def sample_lstm(prompt, max_length=100, params=None, state_key=None, backend=None, seed=None):
+    input_idxs = encode_prompt(prompt, random.Random(seed) if seed is not None else random)
+    return decode_idxs(input_idxs) + decode_idxs(sample_lstm_idxs(input_idxs, max_length, params, state_key, backend, seed))
 
 # Add character context fields
 
@@ -71,6 +340,9 @@ class GenerateRequest(BaseModel):
     model: Optional[str] = "lstm"
     max_length: Optional[int] = 100
     temperature: Optional[float] = 1.0
+    top_k: Optional[int] = None  # sample only from the k most likely characters
+    top_p: Optional[float] = None  # nucleus sampling threshold in (0, 1)
+    greedy: Optional[bool] = False  # always take the most likely character
     backstory: Optional[str] = None
     description: Optional[str] = None
     personality: Optional[str] = None
@@ -83,62 +355,51 @@ class GenerateRequest(BaseModel):
     feedback: Optional[str] = None
     user_skill: Optional[str] = None  # e.g., "beginner", "advanced"
     choice: Optional[str] = None  # for multi-path storytelling
-# --- Enhanced FSM for emotions and actions ---
+    accent: Optional[str] = None  # e.g., "british", "southern", "pirate"
+    style_lstm: Optional[bool] = False  # also apply slang/accent/tone to lstm_generated
+    timings: Optional[bool] = False  # include a per-stage latency breakdown in the response
+    seed: Optional[int] = None  # makes the whole response reproducible
+    timeout_ms: Optional[int] = None  # stop sampling after this long and return what was generated
+# --- Narrative, memory, relationship and personality managers ---
+# Each manager owns one namespace of the shared state store and works on the
+# request's StateSession, so all of a request's reads are prefetched together
+# and its writes are flushed in one batch.
 class NarrativeThread:
-    def __init__(self):
-        self.threads = {}
-    def update(self, user_id, character_id, prompt):
+    namespace = "narrative"
+    def key(self, user_id, character_id):
+        return (self.namespace, (user_id, character_id))
+    def update(self, state, user_id, character_id, prompt):
         # Simple narrative thread: append prompt to thread
         key = (user_id, character_id)
-        if key not in self.threads:
-            self.threads[key] = []
-        self.threads[key].append(prompt)
+        thread = state.get(self.namespace, key, [])
+        thread.append(prompt)
         # Limit thread length for memory
-        self.threads[key] = self.threads[key][-10:]
-        return self.threads[key]
-
-# Contextual memory for each user/character
-class ContextualMemory:
-    def __init__(self):
-        self.memory = {}
-    def recall(self, user_id, character_id):
-        return self.memory.get((user_id, character_id), [])
-    def remember(self, user_id, character_id, entry):
-        key = (user_id, character_id)
-        if key not in self.memory:
-            self.memory[key] = []
-        self.memory[key].append(entry)
-        self.memory[key] = self.memory[key][-20:]
-        return self.memory[key]
-
-# Character relationships (simple graph)
-class CharacterRelationships:
-    def __init__(self):
-        self.graph = {}  # {(char1, char2): strength}
-    def update(self, char1, char2, delta):
-        key = tuple(sorted([char1, char2]))
-        self.graph[key] = self.graph.get(key, 0) + delta
-    def get(self, char1, char2):
-        key = tuple(sorted([char1, char2]))
-        return self.graph.get(key, 0)
+        thread = thread[-10:]
+        state.set(self.namespace, key, thread)
+        return thread
+
+# Contextual memory for each user/character: see memory_index.MemoryIndex
+
+# Character relationships: see relationship_graph.RelationshipGraph
 
 # Dynamic personality (evolves over time)
 class DynamicPersonality:
-    def __init__(self):
-        self.states = {}
-    def update(self, character_id, feedback=None, experience=None):
+    namespace = "personality"
+    def key(self, character_id):
+        return (self.namespace, character_id)
+    def update(self, state, character_id, feedback=None, experience=None):
         # Naive: feedback or experience can nudge personality
-        if character_id not in self.states:
-            self.states[character_id] = {"kind": 1, "sarcastic": 1, "brave": 1, "loyal": 1}
+        traits = state.get(self.namespace, character_id) or {"kind": 1, "sarcastic": 1, "brave": 1, "loyal": 1}
         if feedback:
             if "rude" in feedback:
-                self.states[character_id]["sarcastic"] += 1
+                traits["sarcastic"] += 1
             if "nice" in feedback:
-                self.states[character_id]["kind"] += 1
+                traits["kind"] += 1
         # Clamp values
-        for k in self.states[character_id]:
-            self.states[character_id][k] = max(1, min(10, self.states[character_id][k]))
-        return self.states[character_id]
+        for k in traits:
+            traits[k] = max(1, min(10, traits[k]))
+        state.set(self.namespace, character_id, traits)
+        return traits
 
 # Adaptive difficulty
 def get_difficulty(user_skill):
@@ -148,140 +409,72 @@ def get_difficulty(user_skill):
         return "hard"
     return "normal"
 
-# Human-like behavior: add hesitations, pauses, mistakes
-
-# --- Slang, Jargon, Accent, Tone, Subtext, Humor, Vulnerability ---
-def apply_slang_and_jargon(text, personality=None):
-    # Simple slang/jargon injection for youthful/modern tone
-    slang = [
-        ("hello", "yo"),
-        ("friend", "bro"),
-        ("amazing", "lit"),
-        ("very good", "fire"),
-        ("angry", "salty"),
-        ("sad", "down bad"),
-        ("happy", "hyped"),
-        ("cool", "dope"),
-        ("not sure", "idk"),
-        ("really", "fr"),
-        ("joking", "no cap"),
-        ("serious", "deadass"),
-    ]
-    for k, v in slang:
-        text = text.replace(k, v)
-    # Add more slang for certain personalities
-    if personality and "youthful" in personality.lower():
-        text += " lol"
-    return text
-
-def apply_accent_and_dialect(text, accent=None):
-    # Simple accent/dialect transformation
-    if accent == "british":
-        text = text.replace("color", "colour").replace("favorite", "favourite").replace("mom", "mum")
-        text = text.replace("hello", "'ello")
-    elif accent == "southern":
-        text = text.replace("you", "y'all").replace("my", "mah")
-    elif accent == "pirate":
-        text = text.replace("my", "me").replace("is", "be").replace("hello", "ahoy")
-    return text
-
-def apply_tone_and_inflection(text, emotion=None):
-    # Add tone/inflection cues
-    if emotion == "angry":
-        text = text.upper() + "!"
-    elif emotion == "sad":
-        text = text + "..."
-    elif emotion == "happy":
-        text = text + " :)"
-    elif emotion == "afraid":
-        text = text + " (voice trembling)"
-    return text
-
-def add_subtext(text, personality=None, emotion=None):
-    # Add subtext for nuance
-    if personality and "sarcastic" in personality:
-        text += " (but doesn't really mean it)"
-    elif emotion == "sad":
-        text += " (trying to hide their true feelings)"
-    return text
-
-def add_contextual_reference(text, context=None):
-    # Add a simple contextual reference
-    if context and "Backstory" in context:
-        text += " (remembers their past)"
-    return text
-
-def add_wordplay_and_humor(text, personality=None):
-    # Add wordplay/humor for lightheartedness
-    if personality and "funny" in personality:
-        jokes = [
-            "Why did the AI cross the road? To optimize the chicken!",
-            "I'm not lazy, I'm just on energy-saving mode.",
-            "I would tell you a joke about UDP, but you might not get it."
-        ]
-        text += " " + random.choice(jokes)
-    return text
-
-def add_vulnerability(text, personality=None, emotion=None):
-    # Add vulnerability and imperfection
-    if emotion == "afraid":
-        text += " (voice cracks a little)"
-    if personality and "shy" in personality:
-        text += " (hesitates)"
-    if random.random() < 0.1:
-        text += " Sorry, I might be wrong."
-    return text
-
-def humanize_dialogue(text):
-    if random.random() < 0.2:
-        text = "... " + text
-    if random.random() < 0.2:
-        text = text.replace(",", ", um,")
-    if random.random() < 0.1:
-        text = text + " (pauses)"
-    return text
-
+# Slang, jargon, accent, tone, subtext, humor, vulnerability and human-like
+# hesitations are applied by text_styling.style_dialogue from a compiled profile
 
+# --- Enhanced FSM for emotions and actions ---
+# Emotion lexicon, in priority order: when a prompt hits several emotions the
+# first one listed wins. DEEPGEN_EMOTION_LEXICON can point at a JSON file with
+# the same shape to replace it.
+DEFAULT_EMOTION_LEXICON = {
+    "angry": {"action": "confront", "words": ["angry", "mad", "furious", "rage", "irritated"]},
+    "sad": {"action": "comfort", "words": ["sad", "cry", "upset", "depressed", "tears"]},
+    "happy": {"action": "celebrate", "words": ["happy", "joy", "excited", "delighted", "cheerful"]},
+    "afraid": {"action": "reassure", "words": ["afraid", "scared", "fear", "nervous"]},
+}
 
+def load_emotion_lexicon(path=None):
+    if not path:
+        return DEFAULT_EMOTION_LEXICON
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
 
-# --- Enhanced FSM for emotions and actions ---
 class EmotionFSM:
-    def __init__(self):
-        self.emotion = "neutral"
-        self.action = "idle"
-    def update(self, prompt):
-        # Improved emotion detection
-        p = prompt.lower()
-        if any(w in p for w in ["angry", "mad", "furious", "rage", "irritated"]):
-            self.emotion = "angry"
-            self.action = "confront"
-        elif any(w in p for w in ["sad", "cry", "upset", "depressed", "tears"]):
-            self.emotion = "sad"
-            self.action = "comfort"
-        elif any(w in p for w in ["happy", "joy", "excited", "delighted", "cheerful"]):
-            self.emotion = "happy"
-            self.action = "celebrate"
-        elif any(w in p for w in ["afraid", "scared", "fear", "nervous"]):
-            self.emotion = "afraid"
-            self.action = "reassure"
-        else:
-            self.emotion = "neutral"
-            self.action = "idle"
-        return self.emotion, self.action
+    # Emotion/action state per (user_id, character_id), kept in the state store
+    namespace = "emotion"
+    def __init__(self, lexicon=None):
+        self.lexicon = lexicon or DEFAULT_EMOTION_LEXICON
+        self.priority = {emotion: rank for rank, emotion in enumerate(self.lexicon)}
+        words = {}
+        for emotion, spec in self.lexicon.items():
+            for w in spec["words"]:
+                words.setdefault(w.lower(), emotion)
+        self.matcher = KeywordMatcher(words)
+    def key(self, user_id, character_id):
+        return (self.namespace, (user_id, character_id))
+    def detect(self, prompt):
+        # One pass over the prompt finds every emotion hit; None if there is none
+        hits = self.matcher.find_values(prompt.lower())
+        if not hits:
+            return None
+        emotion = min(hits, key=self.priority.__getitem__)
+        return emotion, self.lexicon[emotion]["action"]
+    def current(self, state, user_id, character_id):
+        if state is None or not (user_id and character_id):
+            return "neutral", "idle"
+        entry = state.get(self.namespace, (user_id, character_id)) or {}
+        return entry.get("emotion", "neutral"), entry.get("action", "idle")
+    def record(self, state, user_id, character_id, emotion, action):
+        if state is not None and user_id and character_id:
+            state.set(self.namespace, (user_id, character_id), {"emotion": emotion, "action": action})
+    def update(self, state, user_id, character_id, detected):
+        # A prompt without emotion keywords keeps the conversation's previous
+        # emotion and action; any hit moves it to the detected one
+        if detected is None:
+            return self.current(state, user_id, character_id)
+        self.record(state, user_id, character_id, *detected)
+        return detected
 
 
 # --- Enhanced Behavior Tree for dialogue selection ---
 def behavior_tree(personality, emotion, action, prompt, motivations, values, backstory, description):
     # Use all available context for nuanced dialogue
-    personality = (personality or "").lower()
-    motivations = (motivations or "").lower()
-    values = (values or "").lower()
-    backstory = (backstory or "").lower()
-    description = (description or "").lower()
-    prompt = prompt.lower()
+    return behavior_reply(behavior_flags(personality, motivations, values), emotion)
 
+def behavior_reply(flags, emotion):
+    # `flags` come from behavior_flags, usually precompiled with the character
     # Sarcastic
-    if "sarcastic" in personality:
+    if "sarcastic" in flags:
         if emotion == "angry":
             return "Oh, great. Just what I needed today. (rolls eyes)"
         elif emotion == "happy":
@@ -293,7 +486,7 @@ def behavior_tree(personality, emotion, action, prompt, motivations, values, bac
         else:
             return "Sure, because that's exactly what I wanted to do."
     # Kind
-    if "kind" in personality:
+    if "kind" in flags:
         if emotion == "angry":
             return "I understand you're upset. Let's try to calm down together. (gentle tone)"
         elif emotion == "happy":
@@ -305,7 +498,7 @@ def behavior_tree(personality, emotion, action, prompt, motivations, values, bac
         else:
             return "How can I help you today?"
     # Brave
-    if "brave" in personality or "courage" in values:
+    if "brave" in flags:
         if emotion == "afraid":
             return "Fear is just a feeling. Let's face it together. (stands tall)"
         elif emotion == "angry":
@@ -313,10 +506,10 @@ def behavior_tree(personality, emotion, action, prompt, motivations, values, bac
         else:
             return "No challenge is too great."
     # Loyal
-    if "loyal" in personality or "loyalty" in values:
+    if "loyal" in flags:
         return "You can always count on me. (steadfast gaze)"
     # Motivated by justice
-    if "justice" in motivations or "justice" in values:
+    if "justice" in flags:
         return "I can't stand by when something's unfair. (firm voice)"
     # Default
     if emotion == "angry":
@@ -331,19 +524,10 @@ def behavior_tree(personality, emotion, action, prompt, motivations, values, bac
 
 
 # --- Enhanced Sensory/Descriptive/Action-Oriented Dialogue Generator ---
-def generate_descriptive_dialogue(req: GenerateRequest, emotion: str, action: str, memory=None, narrative=None, relationship=None, dynamic_personality=None, difficulty="normal"):
+def generate_descriptive_dialogue(req: GenerateRequest, emotion: str, action: str, memory=None, narrative=None, relationship=None, dynamic_personality=None, difficulty="normal", rng=random, character=None):
     # Use all context fields
-    context = []
-    if req.backstory:
-        context.append(f"Backstory: {req.backstory}")
-    if req.description:
-        context.append(f"Description: {req.description}")
-    if req.personality:
-        context.append(f"Personality: {req.personality}")
-    if req.motivations:
-        context.append(f"Motivations: {req.motivations}")
-    if req.values:
-        context.append(f"Values: {req.values}")
+    character = character or CompiledCharacter({name: getattr(req, name) for name in PROFILE_FIELDS})
+    context = list(character.context)
     context_str = "\n".join(context)
 
 
@@ -357,10 +541,7 @@ def generate_descriptive_dialogue(req: GenerateRequest, emotion: str, action: st
             dialogue = f"You make a choice: {req.choice}. (thoughtful)"
     else:
         # Dialogue selection
-        dialogue = behavior_tree(
-            req.personality, emotion, action, req.prompt,
-            req.motivations, req.values, req.backstory, req.description
-        )
+        dialogue = behavior_reply(character.flags, emotion)
 
     # Add narrative thread and memory context
     if narrative:
@@ -386,7 +567,7 @@ def generate_descriptive_dialogue(req: GenerateRequest, emotion: str, action: st
         "The aroma of fresh bread wafts from a nearby bakery.",
         "Rain patters softly against the glass."
     ]
-    sensory = random.choice(sensory_options)
+    sensory = rng.choice(sensory_options)
 
     # Enhanced action-oriented cues
     action_options = [
@@ -403,26 +584,20 @@ def generate_descriptive_dialogue(req: GenerateRequest, emotion: str, action: st
     ]
     # Optionally bias action to emotion/action state
     if action == "comfort":
-        action_cue = random.choice(["(offers a comforting smile)", "(places a gentle hand on your shoulder)"])
+        action_cue = rng.choice(["(offers a comforting smile)", "(places a gentle hand on your shoulder)"])
     elif action == "confront":
-        action_cue = random.choice(["(stands tall, unyielding)", "(voice sharp, unwavering)"])
+        action_cue = rng.choice(["(stands tall, unyielding)", "(voice sharp, unwavering)"])
     elif action == "celebrate":
-        action_cue = random.choice(["(claps hands joyfully)", "(grins with excitement)"])
+        action_cue = rng.choice(["(claps hands joyfully)", "(grins with excitement)"])
     elif action == "reassure":
-        action_cue = random.choice(["(softly reassures)", "(gives a calming nod)"])
+        action_cue = rng.choice(["(softly reassures)", "(gives a calming nod)"])
     else:
-        action_cue = random.choice(action_options)
+        action_cue = rng.choice(action_options)
 
 
     # --- Slang, Jargon, Accent, Tone, Subtext, Contextual Reference, Humor, Vulnerability ---
-    dialogue = apply_slang_and_jargon(dialogue, req.personality)
-    dialogue = apply_accent_and_dialect(dialogue, accent=getattr(req, 'accent', None))
-    dialogue = apply_tone_and_inflection(dialogue, emotion)
-    dialogue = add_subtext(dialogue, req.personality, emotion)
-    dialogue = add_contextual_reference(dialogue, context_str)
-    dialogue = add_wordplay_and_humor(dialogue, req.personality)
-    dialogue = add_vulnerability(dialogue, req.personality, emotion)
-    dialogue = humanize_dialogue(dialogue)
+    profile = compile_profile(req.personality, req.accent, emotion, traits=character.traits)
+    dialogue = style_dialogue(dialogue, profile, context_str, rng)
 
     # Compose response
     response = {
@@ -445,63 +620,513 @@ def generate_descriptive_dialogue(req: GenerateRequest, emotion: str, action: st
 
 
 # --- Instantiate narrative, memory, relationship, and dynamic personality managers ---
-emotion_fsm = EmotionFSM()
+# DEEPGEN_STATE_BACKEND=sqlite (default) is durable and shared by all workers on
+# the host; "memory" keeps state in this process only.
+state_store = open_state_store(
+    backend=os.environ.get("DEEPGEN_STATE_BACKEND", "sqlite"),
+    path=os.environ.get("DEEPGEN_STATE_PATH", "deepgen_state.sqlite3"),
+    max_entries=int(os.environ.get("DEEPGEN_STATE_MAX_ENTRIES", "100000")),
+    ttl_seconds=float(os.environ.get("DEEPGEN_STATE_TTL", str(7 * 24 * 3600))),
+    persistent=(CharacterRegistry.namespace, RelationshipGraph.namespace),
+    # Memory entries live as long as their conversation's header, in their own
+    # LRU so long conversations do not push out other state
+    owned={MemoryIndex.entry_namespace: MemoryIndex.namespace},
+    # Relationship nodes skip the TTL but stay bounded: with the memory backend
+    # the least recently touched nodes are dropped past this many
+    budgets={
+        MemoryIndex.entry_namespace: int(os.environ.get("DEEPGEN_STATE_MEMORY_ENTRIES", "100000")),
+        RelationshipGraph.namespace: int(os.environ.get("DEEPGEN_STATE_RELATIONSHIP_NODES", "100000")),
+    },
+)
+# State sessions may wait on SQLite's write lock (up to its busy timeout) while
+# other workers write, so they run on their own threads, never on the event loop
+state_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("DEEPGEN_STATE_THREADS", "4")),
+                                    thread_name_prefix="state")
+
+async def run_state(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(state_executor, fn, *args)
+
+async def in_session(fn, *args):
+    # fn(state, *args) in a state session of its own
+    def run():
+        with state_store.session() as state:
+            return fn(state, *args)
+    return await run_state(run)
+
+character_registry = CharacterRegistry(int(os.environ.get("DEEPGEN_CHARACTER_CACHE_SIZE", "1024")))
+emotion_fsm = EmotionFSM(load_emotion_lexicon(os.environ.get("DEEPGEN_EMOTION_LEXICON")))
 narrative_manager = NarrativeThread()
-memory_manager = ContextualMemory()
-relationship_manager = CharacterRelationships()
+memory_manager = MemoryIndex(
+    max_entries=int(os.environ.get("DEEPGEN_MEMORY_MAX_ENTRIES", "1000")),
+    max_chars=int(os.environ.get("DEEPGEN_MEMORY_MAX_CHARS", "500")),
+    top_k=int(os.environ.get("DEEPGEN_MEMORY_TOP_K", "5")),
+    cache_size=int(os.environ.get("DEEPGEN_MEMORY_CACHE_SIZE", "256")),
+)
+relationship_manager = RelationshipGraph(
+    half_life_seconds=float(os.environ.get("DEEPGEN_RELATIONSHIP_HALF_LIFE", str(30 * 24 * 3600))),
+    max_degree=int(os.environ.get("DEEPGEN_RELATIONSHIP_MAX_DEGREE", "256")),
+)
 dynamic_personality_manager = DynamicPersonality()
 
 
-@app.post("/generate")
-async def generate_text(req: GenerateRequest):
-    # Update emotion and action state
-    emotion, action = emotion_fsm.update(req.prompt)
+@app.exception_handler(QueueFull)
+async def queue_full_handler(request, exc: QueueFull):
+    REJECTED.inc()
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Generation queue is full", "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+async def admit_generation():
+    # Raises QueueFull before any state is touched; the slot is held until the response is done
+    with generation_pool.admit():
+        yield
+
+# --- Metrics (Prometheus text format at /metrics; DEEPGEN_METRICS=0 turns recording off) ---
+METRICS_ENABLED = os.environ.get("DEEPGEN_METRICS", "1") != "0"
+metrics_registry = Registry()
+STAGE_SECONDS = metrics_registry.histogram(
+    "deepgen_stage_seconds", "Time spent in each stage of a generation request", ["stage"])
+REQUESTS = metrics_registry.counter("deepgen_requests_total", "Generation requests completed", ["endpoint"])
+TOKENS = metrics_registry.counter("deepgen_tokens_generated_total", "Characters sampled from the LSTM")
+TOKENS_PER_SECOND = metrics_registry.histogram(
+    "deepgen_tokens_per_second", "Per-request LSTM sampling rate",
+    buckets=(100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000))
+metrics_registry.gauge("deepgen_inflight_requests", "Admitted generation requests not yet finished",
+                       fn=lambda: generation_pool.pending)
+metrics_registry.gauge("deepgen_queue_depth", "Jobs waiting for a worker or batch slot", ["queue"],
+                       fn=lambda: {"pool": generation_pool.stats()["queue_depth"], "batcher": sum(b.stats()["queue_depth"] for b in list(lstm_batchers.values()))})
+metrics_registry.gauge("deepgen_state_entries", "Entries held by each state store (SQLite rows as of the last purge)", ["store"],
+                       fn=lambda: {"state_store": len(state_store), "hidden_state_cache": len(lstm_state_cache),
+                                   "response_cache": len(response_cache)})
+metrics_registry.gauge("deepgen_hidden_state_cache_bytes", "Bytes of LSTM hidden state cached",
+                       fn=lambda: lstm_state_cache.bytes)
+REJECTED = metrics_registry.counter("deepgen_rejected_total", "Requests turned away because the queue was full")
+RESPONSE_CACHE = metrics_registry.counter("deepgen_response_cache_total", "Deterministic continuation cache lookups", ["result"])
+TRUNCATED = metrics_registry.counter("deepgen_truncated_total", "LSTM continuations cut short by a limit or a disconnect", ["reason"])
+
+def record_finish(reason):
+    if METRICS_ENABLED and reason != "length":
+        TRUNCATED.inc(1, reason)
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+# --- Startup and readiness ---
+# DEEPGEN_WARMUP=0 skips the warm-up: the worker is ready at once and the
+# first request loads the model.
+WARMUP_ENABLED = os.environ.get("DEEPGEN_WARMUP", "1") != "0"
+readiness = {"ready": not WARMUP_ENABLED, "error": None, "warmup_seconds": None}
+
+def warm_up():
+    # Load the model, build the default backend and run a short generation
+    # through the path requests take, so the first real request pays for
+    # neither lazy initialisation nor first-call kernel and allocator setup
+    started = time.perf_counter()
+    try:
+        backend = lstm_backends.get().name
+        if MAX_BATCH_SIZE > 1:
+            get_batcher(backend).submit(encode_prompt("warm up"), 8).result()
+        else:
+            sample_lstm("warm up", 8, SamplingParams(), None, backend)
+        compose_response(GenerateRequest(prompt="warm up"))
+    except Exception as e:
+        readiness["error"] = f"{type(e).__name__}: {e}"
+        return
+    readiness["warmup_seconds"] = round(time.perf_counter() - started, 3)
+    readiness["ready"] = True
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the process is up and serving; says nothing about the model
+    return {"status": "ok"}
 
+@app.get("/readyz")
+async def readyz():
+    if readiness["ready"]:
+        return {"status": "ready", "backend": lstm_backends.default, "checkpoint": CHECKPOINT_PATH,
+                "warmup_seconds": readiness["warmup_seconds"]}
+    status = "failed" if readiness["error"] else "starting"
+    return JSONResponse(status_code=503, content={"status": status, "error": readiness["error"]})
+
+@app.get("/status")
+async def status():
+    return {
+        "pool": generation_pool.stats(),
+        "lstm_backends": {"default": lstm_backends.default, "loaded": lstm_backends.loaded()},
+        "batchers": {name: b.stats() for name, b in list(lstm_batchers.items())},
+        "state_cache": lstm_state_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "state_store": state_store.stats(),
+        "characters": character_registry.stats(),
+        "relationships": relationship_manager.stats(),
+        "memory": memory_manager.stats(),
+    }
+
+def state_keys(req: GenerateRequest):
+    # Every state entry a request reads, so a session can fetch them in one go
+    keys = []
+    if req.user_id and req.character_id:
+        keys.append(emotion_fsm.key(req.user_id, req.character_id))
+        keys.append(narrative_manager.key(req.user_id, req.character_id))
+        keys.append(memory_manager.key(req.user_id, req.character_id))
+        keys.extend(relationship_manager.keys(req.character_id, req.user_id))
+    if req.character_id:
+        keys.append(dynamic_personality_manager.key(req.character_id))
+        keys.append(character_registry.key(req.character_id))
+    return keys
+
+def update_conversation_state(state, req: GenerateRequest):
     # Narrative thread and contextual memory
-    narrative = narrative_manager.update(req.user_id, req.character_id, req.prompt) if req.user_id and req.character_id else None
-    memory = memory_manager.recall(req.user_id, req.character_id) if req.user_id and req.character_id else None
-    memory_manager.remember(req.user_id, req.character_id, req.prompt) if req.user_id and req.character_id else None
+    narrative = narrative_manager.update(state, req.user_id, req.character_id, req.prompt) if req.user_id and req.character_id else None
+    memory = memory_manager.recall(state, req.user_id, req.character_id, req.prompt) if req.user_id and req.character_id else None
+    memory_manager.remember(state, req.user_id, req.character_id, req.prompt) if req.user_id and req.character_id else None
 
     # Character relationships (for multi-character scenarios)
     relationship = None
     if req.character_id and req.user_id:
         # Example: user_id is treated as another character for relationship
-        relationship = relationship_manager.get(req.character_id, req.user_id)
+        relationship = relationship_manager.get(state, req.character_id, req.user_id)
         # Optionally update relationship based on feedback
         if req.feedback:
             delta = 1 if "positive" in req.feedback else -1 if "negative" in req.feedback else 0
-            relationship_manager.update(req.character_id, req.user_id, delta)
+            relationship_manager.update(state, req.character_id, req.user_id, delta)
 
     # Dynamic personality
     dynamic_personality = None
     if req.character_id:
-        dynamic_personality = dynamic_personality_manager.update(req.character_id, feedback=req.feedback)
+        dynamic_personality = dynamic_personality_manager.update(state, req.character_id, feedback=req.feedback)
+    return narrative, memory, relationship, dynamic_personality
 
-    # Adaptive difficulty
-    difficulty = get_difficulty(req.user_skill)
+def resolve_character(state, req: GenerateRequest):
+    # Profile fields the request leaves out come from the character's
+    # registered profile. Its precompiled flags, context and style traits are
+    # used as they are unless the request overrides a field or adds an
+    # environment; otherwise the merged profile is compiled for this request.
+    registered = character_registry.get(state, req.character_id)
+    overridden = any(getattr(req, name) is not None for name in PROFILE_FIELDS)
+    if registered is not None:
+        for name, value in registered.fields.items():
+            if getattr(req, name) is None:
+                setattr(req, name, value)
 
     # Environmental influence (affect sensory/action cues)
     # (For demo, just append to context)
     if req.environment:
         env_desc = ", ".join(f"{k}: {v}" for k, v in req.environment.items())
         req.description = (req.description or "") + f" Environment: {env_desc}"
+    elif registered is not None and not overridden:
+        return registered
+    return CompiledCharacter({name: getattr(req, name) for name in PROFILE_FIELDS})
+
+def compose_dialogue(req: GenerateRequest, emotion, action, context, character):
+    narrative, memory, relationship, dynamic_personality = context
+
+    # Adaptive difficulty
+    difficulty = get_difficulty(req.user_skill)
 
     # Generate descriptive, personality-driven, action-oriented dialogue
-    response = generate_descriptive_dialogue(
+    return generate_descriptive_dialogue(
         req, emotion, action,
         memory=memory, narrative=narrative, relationship=relationship,
-        dynamic_personality=dynamic_personality, difficulty=difficulty
+        dynamic_personality=dynamic_personality, difficulty=difficulty, rng=request_rng(req),
+        character=character
     )
 
-    # Optionally, generate a dummy LSTM output for the dialogue (for demo)
-    if req.model and req.model.lower() == "lstm":
-        # Use the composed descriptive string as prompt
-        generated = sample_lstm(response["descriptive"], req.max_length or 100, req.temperature or 1.0)
-        response["lstm_generated"] = generated
-    else:
+def compose_responses(reqs, timer=None):
+    # Rule-based stage for one or more requests. The state of all of them is
+    # fetched in one query and written back in one transaction. Returns, per
+    # request and in order, its response dict or the exception it raised.
+    timer = timer or StageTimer(enabled=False)
+    results = [None] * len(reqs)
+    contexts = [None] * len(reqs)
+    characters = [None] * len(reqs)
+    with timer.stage("emotion"):
+        detected = [emotion_fsm.detect(req.prompt) for req in reqs]
+    with timer.stage("state"), state_store.session() as state:
+        state.prefetch([key for req in reqs for key in state_keys(req)])
+        for i, req in enumerate(reqs):
+            try:
+                characters[i] = resolve_character(state, req)
+                # Advance this conversation's emotion and action state
+                detected[i] = emotion_fsm.update(state, req.user_id, req.character_id, detected[i])
+                contexts[i] = update_conversation_state(state, req)
+            except Exception as e:
+                results[i] = e
+    with timer.stage("dialogue"):
+        for i, req in enumerate(reqs):
+            if results[i] is None:
+                try:
+                    results[i] = compose_dialogue(req, *detected[i], contexts[i], characters[i])
+                except Exception as e:
+                    results[i] = e
+    return results
+
+def compose_response(req: GenerateRequest, timer=None):
+    # Rule-based stage shared by /generate and /generate/stream
+    result = compose_responses([req], timer)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def record_request_metrics(timer, endpoint, tokens, lstm_seconds):
+    timer.observe(STAGE_SECONDS)
+    REQUESTS.inc(1, endpoint)
+    if tokens:
+        TOKENS.inc(tokens)
+        if lstm_seconds > 0:
+            TOKENS_PER_SECOND.observe(tokens / lstm_seconds)
+
+def is_deterministic(req: GenerateRequest, params):
+    return req.seed is not None or params.greedy
+
+def continuation_cache_key(req: GenerateRequest, response, backend, params):
+    # A deterministic continuation starts from a zero hidden state (a resumed
+    # conversation state is not part of this key), so it is fully determined
+    # by the composed prompt, backend, sampling parameters, seed and length
+    if not response_cache.max_entries or not is_deterministic(req, params):
+        return None
+    return response_cache.key(backend, response["descriptive"], generation_length(req)[0],
+                              params.temperature, params.top_k, params.top_p, params.greedy, req.seed)
+
+def cached_continuation(key):
+    if key is None:
+        return None
+    text = response_cache.get(key)
+    if METRICS_ENABLED:
+        RESPONSE_CACHE.inc(1, "miss" if text is None else "hit")
+    return text
+
+async def add_continuation(req: GenerateRequest, response, backend, budget=None):
+    # Optionally, generate a dummy LSTM output for the dialogue (for demo).
+    # Sets response["lstm_generated"] (and, for the LSTM, lstm_finish_reason);
+    # returns the number of characters sampled.
+    if backend is None:
         response["lstm_generated"] = f"[GAN OUTPUT] {response['descriptive']} ... (GAN not implemented in this demo)"
+        return 0
+    # Use the composed descriptive string as prompt
+    prompt, params = response["descriptive"], sampling_params(req)
+    max_length, capped = generation_length(req)
+    key = continuation_cache_key(req, response, backend, params)
+    input_idxs = encode_prompt(prompt, request_rng(req))
+    continuation = cached_continuation(key)
+    if continuation is not None:
+        sampled, reason = 0, "max_length" if capped else "length"
+    else:
+        state_key = None if is_deterministic(req, params) else conversation_key(req)
+        idxs = await generate_lstm(input_idxs, max_length, params, state_key, backend, req.seed, budget)
+        sampled, reason = len(idxs), finish_reason(len(idxs), max_length, capped, budget)
+        continuation = decode_idxs(idxs)
+        # A partial continuation is not what the same request would get next time
+        if key is not None and sampled == max_length:
+            response_cache.put(key, continuation)
+    record_finish(reason)
+    generated = decode_idxs(input_idxs) + continuation
+    if req.style_lstm:
+        generated = compile_profile(req.personality, req.accent, response["emotion"]).transform(generated)
+    response["lstm_generated"] = generated
+    response["lstm_finish_reason"] = reason
+    return sampled
+
+@app.post("/generate", dependencies=[Depends(admit_generation)])
+async def generate_text(req: GenerateRequest, request: Request):
+    budget = generation_budget(req)
+    backend = lstm_backend(req)
+    sampling_params(req)  # a 400 for bad sampling settings, before any state is written
+    timer = StageTimer(enabled=METRICS_ENABLED or bool(req.timings))
+    started = time.perf_counter()
+    response = await run_state(compose_response, req, timer)
+
+    with timer.stage("lstm"):
+        async with stop_on_disconnect(request, budget):
+            tokens = await add_continuation(req, response, backend, budget)
+    timer.add("total", time.perf_counter() - started)
+    if METRICS_ENABLED:
+        record_request_metrics(timer, "generate", tokens, timer.stages.get("lstm", 0.0))
+    if req.timings:
+        response["timings_ms"] = timer.breakdown_ms()
+    return response
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/generate/stream")
+async def generate_stream(req: GenerateRequest):
+    # Server-sent events: one "meta" event with the descriptive fields, then
+    # "token" events carrying LSTM text as it is sampled, then "done" (with
+    # the LSTM's finish_reason). When the client disconnects the response
+    # generator is closed, which stops the sampling loop.
+    budget = generation_budget(req)
+    backend = lstm_backend(req)
+    params = sampling_params(req)
+    admission = generation_pool.admit()
+    timer = StageTimer(enabled=METRICS_ENABLED or bool(req.timings))
+    started = time.perf_counter()
+    try:
+        response = await run_state(compose_response, req, timer)
+    except Exception:
+        admission.__exit__(None, None, None)
+        raise
+
+    async def events():
+        with admission:
+            yield sse_event("meta", response)
+            tokens = 0
+            done = {}
+            if backend is not None:
+                lstm_started = time.perf_counter()
+                max_length, capped = generation_length(req)
+                key = continuation_cache_key(req, response, backend, params)
+                continuation = cached_continuation(key)
+                if continuation is not None:
+                    timer.add("first_token", time.perf_counter() - started)
+                    yield sse_event("token", {"text": continuation})
+                    reason = "max_length" if capped else "length"
+                else:
+                    state_key = None if is_deterministic(req, params) else conversation_key(req)
+                    parts = []  # kept only to fill the cache
+                    async for text in stream_lstm(response["descriptive"], max_length, params, state_key, backend, req.seed, budget):
+                        if not tokens:
+                            timer.add("first_token", time.perf_counter() - started)
+                        tokens += len(text)
+                        if key is not None:
+                            parts.append(text)
+                        yield sse_event("token", {"text": text})
+                    # Only the budget can stop sampling early, so it alone tells a partial run
+                    reason = budget.reason or ("max_length" if capped else "length")
+                    if key is not None and budget.reason is None:
+                        response_cache.put(key, "".join(parts))
+                record_finish(reason)
+                done["finish_reason"] = reason
+                timer.add("lstm", time.perf_counter() - lstm_started)
+            else:
+                yield sse_event("token", {"text": f"[GAN OUTPUT] {response['descriptive']} ... (GAN not implemented in this demo)"})
+            timer.add("total", time.perf_counter() - started)
+            if METRICS_ENABLED:
+                record_request_metrics(timer, "generate_stream", tokens, timer.stages.get("lstm", 0.0))
+            if req.timings:
+                done["timings_ms"] = timer.breakdown_ms()
+            yield sse_event("done", done)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- Batches (e.g. one reply from each character in a group scene) ---
+MAX_BATCH_ITEMS = int(os.environ.get("DEEPGEN_MAX_BATCH_ITEMS", "32"))
+
+class BatchGenerateRequest(BaseModel):
+    requests: List[GenerateRequest]
+    timings: Optional[bool] = False
+
+def item_error(exc):
+    if isinstance(exc, HTTPException):
+        return {"error": exc.detail, "status": exc.status_code}
+    return {"error": f"{type(exc).__name__}: {exc}", "status": 500}
+
+@app.post("/generate/batch")
+async def generate_batch(batch: BatchGenerateRequest, request: Request):
+    # Runs the rule-based stage for every item with one state session, then
+    # submits all LSTM continuations at once so they share batched steps.
+    # Results come back in request order; a failing item gets an error entry
+    # and does not fail the others. Each item has its own time budget.
+    reqs = batch.requests
+    budgets = [generation_budget(req) for req in reqs]
+    if len(reqs) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_BATCH_ITEMS} requests per batch")
+    with generation_pool.admit(len(reqs) or 1):
+        timer = StageTimer(enabled=METRICS_ENABLED or bool(batch.timings))
+        started = time.perf_counter()
+        results = [None] * len(reqs)
+        backends = [None] * len(reqs)
+        for i, req in enumerate(reqs):
+            # Bad settings fail the item here, before any of its state is written
+            try:
+                backends[i] = lstm_backend(req)
+                sampling_params(req)
+            except HTTPException as e:
+                results[i] = e
+        ok = [i for i in range(len(reqs)) if results[i] is None]
+        for i, result in zip(ok, await run_state(compose_responses, [reqs[i] for i in ok], timer)):
+            results[i] = result
+        ok = [i for i in ok if not isinstance(results[i], Exception)]
+        with timer.stage("lstm"):
+            async with stop_on_disconnect(request, *budgets):
+                outcomes = await asyncio.gather(*(add_continuation(reqs[i], results[i], backends[i], budgets[i]) for i in ok),
+                                                return_exceptions=True)
+        tokens = 0
+        for i, outcome in zip(ok, outcomes):
+            if isinstance(outcome, Exception):
+                results[i] = outcome
+            else:
+                tokens += outcome
+        timer.add("total", time.perf_counter() - started)
+        if METRICS_ENABLED:
+            record_request_metrics(timer, "generate_batch", tokens, timer.stages.get("lstm", 0.0))
+    response = {"results": [item_error(r) if isinstance(r, Exception) else r for r in results]}
+    if batch.timings:
+        response["timings_ms"] = timer.breakdown_ms()
     return response
 
+# --- Character profiles (register once, then send only character_id) ---
+class CharacterProfile(BaseModel):
+    backstory: Optional[str] = None
+    description: Optional[str] = None
+    personality: Optional[str] = None
+    motivations: Optional[str] = None
+    values: Optional[str] = None
+    accent: Optional[str] = None
+
+def character_summary(character_id, compiled):
+    return {"character_id": character_id, "version": compiled.version, "fields": compiled.fields,
+            "flags": sorted(compiled.flags)}
+
+@app.put("/characters/{character_id}")
+async def put_character(character_id: str, profile: CharacterProfile):
+    compiled = await in_session(character_registry.put, character_id, profile.model_dump())
+    return character_summary(character_id, compiled)
+
+@app.get("/characters/{character_id}")
+async def get_character(character_id: str):
+    compiled = await in_session(character_registry.get, character_id)
+    if compiled is None:
+        raise HTTPException(status_code=404, detail=f"unknown character: {character_id}")
+    return character_summary(character_id, compiled)
+
+@app.delete("/characters/{character_id}")
+async def delete_character(character_id: str):
+    def delete(state):
+        found = character_registry.stored(state, character_id) is not None
+        character_registry.delete(state, character_id)
+        return found
+    if not await in_session(delete):
+        raise HTTPException(status_code=404, detail=f"unknown character: {character_id}")
+    return {"character_id": character_id, "deleted": True}
+
+# --- Relationships (neighborhood lookups and batched feedback) ---
+class RelationshipUpdate(BaseModel):
+    source: str
+    target: str
+    delta: float
+
+class RelationshipUpdates(BaseModel):
+    updates: List[RelationshipUpdate]
+
+@app.get("/relationships/{node_id}")
+async def get_relationships(node_id: str, k: int = 10, full: bool = False):
+    # The k strongest ties of a character (or user), strongest first; every
+    # tie with ?full=true
+    if full:
+        ties = sorted((await in_session(relationship_manager.neighbors, node_id)).items(), key=lambda tie: -abs(tie[1]))
+    else:
+        ties = await in_session(relationship_manager.strongest, node_id, max(0, k))
+    return {"id": node_id, "relationships": [{"id": other, "strength": strength} for other, strength in ties]}
+
+@app.post("/relationships")
+async def update_relationships(body: RelationshipUpdates):
+    await in_session(relationship_manager.update_many, [(u.source, u.target, u.delta) for u in body.updates])
+    return {"updated": len(body.updates)}
+
 # ---
 # Note: For graph-based models, evolutionary algorithms, and reinforcement learning,
 # you would integrate those in the managers above or in the dialogue/action selection logic.
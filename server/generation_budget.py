@@ -0,0 +1,45 @@
+# generation_budget.py
+# Per-request time budget and cancellation for LSTM sampling.
+#
+# A Budget is created when a request arrives and handed to whichever loop
+# samples its continuation (decode_steps, or a row of the LSTMBatcher). The
+# loops check it once per token, cooperatively: when the deadline passes or
+# the request is cancelled (e.g. its client disconnected) they stop sampling
+# for that request and return what they have so far. A request whose budget
+# runs out while it is still queued never starts. The first reason recorded
+# ("deadline", "disconnected", ...) is reported with the partial output.
+#
+# The deadline is on the monotonic clock, which on Linux is shared by all
+# processes, so it still holds in a process-pool worker; cancel() only reaches
+# loops running in this process.
+import time
+
+
+class Budget:
+    __slots__ = ("deadline", "reason")
+
+    def __init__(self, seconds=None):
+        self.deadline = time.monotonic() + max(0.0, seconds) if seconds is not None else None
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        if self.reason is None:
+            self.reason = reason
+
+    def exhausted(self):
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.reason = "deadline"
+        return self.reason is not None
+
+    def remaining(self):
+        """Seconds left before the deadline (None without one)."""
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+
+def request_budget(timeout_ms=None, max_seconds=0.0):
+    """Budget for a request asking for `timeout_ms`, capped at the server-wide
+    `max_seconds` (0 = no server limit)."""
+    seconds = max_seconds or None
+    if timeout_ms is not None:
+        seconds = min(timeout_ms / 1000.0, seconds or float("inf"))
+    return Budget(seconds)
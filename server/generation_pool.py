@@ -0,0 +1,119 @@
+# generation_pool.py
+# Runs CPU-bound LSTM generation off the asyncio event loop.
+#
+# GenerationPool wraps a thread or process executor behind a bounded admission
+# counter: once max_pending generations are in flight, new requests are turned
+# away with QueueFull (served as 503 + Retry-After) instead of piling up behind
+# the ones already running.
+import asyncio
+import math
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"generation queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class WaitStats:
+    # Running count/mean/max of a duration, safe to record from worker threads
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.last = seconds
+            self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.mean * 1000, 3),
+            "last_ms": round(self.last * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+def _timed_call(fn, *args):
+    # Executed in the worker; wall-clock start so it is comparable across processes
+    started = time.time()
+    return started, fn(*args)
+
+
+class _Admission:
+    def __init__(self, pool, slots=1):
+        self.pool = pool
+        self.slots = slots
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.pending -= self.slots
+        return False
+
+
+class GenerationPool:
+    def __init__(self, kind="thread", workers=None, max_pending=64):
+        self.kind = kind
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.max_pending = max(1, int(max_pending))
+        if kind == "process":
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        elif kind == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="lstm-worker")
+        else:
+            raise ValueError(f"unknown pool kind: {kind!r} (expected 'thread' or 'process')")
+        self.pending = 0  # admitted and not yet finished; only touched on the event loop
+        self.rejected = 0
+        self.waits = WaitStats()
+        self.service = WaitStats()
+
+    def admit(self, slots=1):
+        """Reserve `slots` slots (one per generation) or raise QueueFull. Use
+        the returned object as a context manager to release them. A request
+        for more slots than max_pending is admitted only when the pool is idle."""
+        if self.pending and self.pending + slots > self.max_pending:
+            self.rejected += 1
+            raise QueueFull(self.retry_after())
+        self.pending += slots
+        return _Admission(self, slots)
+
+    async def run(self, fn, *args):
+        submitted = time.time()
+        future = self._executor.submit(_timed_call, fn, *args)
+        started, result = await asyncio.wrap_future(future)
+        self.waits.record(max(0.0, started - submitted))
+        self.service.record(time.time() - started)
+        return result
+
+    def retry_after(self):
+        # Time for the current backlog to drain at the observed service rate
+        backlog = self.pending * (self.service.mean or 0.1) / self.workers
+        return max(1, math.ceil(backlog))
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "pending": self.pending,
+            "queue_depth": max(0, self.pending - self.workers),
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "queue_wait": self.waits.snapshot(),
+            "service_time": self.service.snapshot(),
+        }
@@ -5,6 +5,7 @@ const prisma = new PrismaClient();
 const path = require("path");
 const { OpenAI } = require("openai");
 const express = require('express');
+const { pipeline } = require('stream');
 const cors = require('cors');
 const app = express();
 // Middleware (must be before any routes)
@@ -179,25 +180,123 @@ app.post('/markov-demo', async (req, res) => {
 const DEEPGEN_API_URL = process.env.DEEPGEN_API_URL || 'http://localhost:8000/generate';
 const fetch = (...args) => import('node-fetch').then(({default: fetch}) => fetch(...args));
 
+// Give up on the Python service after DEEPGEN_TIMEOUT_MS. The default sits a little
+// above the service's own DEEPGEN_MAX_GENERATION_SECONDS, so it normally answers
+// first with partial output. Aborting (or the client going away) closes the
+// connection, which stops the generation on the Python side.
+const DEEPGEN_TIMEOUT_MS = parseInt(process.env.DEEPGEN_TIMEOUT_MS || '35000', 10);
+
 app.post('/deepgen', async (req, res) => {
-  const { prompt, model, max_length, temperature } = req.body;
+  const { prompt, model, max_length, temperature, timeout_ms } = req.body;
   if (!prompt || typeof prompt !== 'string') {
     return res.status(400).json({ error: 'prompt (string) is required.' });
   }
+  const controller = new AbortController();
+  const timer = setTimeout(() => controller.abort(), DEEPGEN_TIMEOUT_MS);
+  res.on('close', () => { if (!res.writableFinished) controller.abort(); });
   try {
     const pyRes = await fetch(DEEPGEN_API_URL, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ prompt, model, max_length, temperature })
+      body: JSON.stringify({ prompt, model, max_length, temperature, timeout_ms }),
+      signal: controller.signal
     });
     if (!pyRes.ok) {
       const err = await pyRes.text();
-      return res.status(500).json({ error: 'Python service error', details: err });
+      const retryAfter = pyRes.headers.get('retry-after');
+      if (retryAfter) res.set('Retry-After', retryAfter);
+      return res.status(pyRes.status === 503 ? 503 : 500).json({ error: 'Python service error', details: err });
     }
     const data = await pyRes.json();
     res.json({ generated: data.generated });
   } catch (e) {
+    if (e.name === 'AbortError') {
+      if (!res.headersSent) res.status(504).json({ error: 'deepgen service timed out' });
+      return;
+    }
+    res.status(500).json({ error: 'Failed to contact deepgen service', details: e.message });
+  } finally {
+    clearTimeout(timer);
+  }
+});
+
+// Streaming variant: pipes the Python service's server-sent events straight through
+// so the client sees the descriptive fields and LSTM characters as they are produced.
+const DEEPGEN_STREAM_URL = process.env.DEEPGEN_STREAM_URL || `${DEEPGEN_API_URL}/stream`;
+
+app.post('/deepgen/stream', async (req, res) => {
+  const { prompt } = req.body;
+  if (!prompt || typeof prompt !== 'string') {
+    return res.status(400).json({ error: 'prompt (string) is required.' });
+  }
+  // express.json() has already read (and closed) req, so only res reports
+  // the client going away; aborting stops the generation upstream
+  const controller = new AbortController();
+  res.on('close', () => { if (!res.writableFinished) controller.abort(); });
+  try {
+    const pyRes = await fetch(DEEPGEN_STREAM_URL, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(req.body),
+      signal: controller.signal
+    });
+    if (!pyRes.ok) {
+      const err = await pyRes.text();
+      const retryAfter = pyRes.headers.get('retry-after');
+      if (retryAfter) res.set('Retry-After', retryAfter);
+      return res.status(pyRes.status === 503 ? 503 : 500).json({ error: 'Python service error', details: err });
+    }
+    res.set({
+      'Content-Type': 'text/event-stream',
+      'Cache-Control': 'no-cache',
+      'Connection': 'keep-alive',
+      'X-Accel-Buffering': 'no'
+    });
+    res.flushHeaders();
+    // pipeline tears down both ends if either fails, e.g. an upstream reset
+    pipeline(pyRes.body, res, (err) => {
+      if (err && !controller.signal.aborted) console.error('deepgen stream failed:', err.message);
+    });
+  } catch (e) {
+    if (e.name === 'AbortError') return;
+    res.status(500).json({ error: 'Failed to contact deepgen service', details: e.message });
+  }
+});
+
+// Batch variant for group scenes: one round-trip returns a reply per character,
+// in order, with per-item errors in place of failed replies.
+const DEEPGEN_BATCH_URL = process.env.DEEPGEN_BATCH_URL || `${DEEPGEN_API_URL}/batch`;
+
+app.post('/deepgen/batch', async (req, res) => {
+  const { requests } = req.body;
+  if (!Array.isArray(requests) || requests.some(r => !r || typeof r.prompt !== 'string')) {
+    return res.status(400).json({ error: 'requests (array of objects with a string prompt) is required.' });
+  }
+  const controller = new AbortController();
+  const timer = setTimeout(() => controller.abort(), DEEPGEN_TIMEOUT_MS);
+  res.on('close', () => { if (!res.writableFinished) controller.abort(); });
+  try {
+    const pyRes = await fetch(DEEPGEN_BATCH_URL, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(req.body),
+      signal: controller.signal
+    });
+    if (!pyRes.ok) {
+      const err = await pyRes.text();
+      const retryAfter = pyRes.headers.get('retry-after');
+      if (retryAfter) res.set('Retry-After', retryAfter);
+      return res.status(pyRes.status === 503 ? 503 : pyRes.status === 400 ? 400 : 500).json({ error: 'Python service error', details: err });
+    }
+    res.json(await pyRes.json());
+  } catch (e) {
+    if (e.name === 'AbortError') {
+      if (!res.headersSent) res.status(504).json({ error: 'deepgen service timed out' });
+      return;
+    }
     res.status(500).json({ error: 'Failed to contact deepgen service', details: e.message });
+  } finally {
+    clearTimeout(timer);
   }
 });
 
@@ -0,0 +1,74 @@
+# keyword_matcher.py
+# Single-pass keyword matching with one compiled regex.
+#
+# The keywords are folded into a trie and emitted as a prefix-factored
+# alternation ("sad|scared|scary" -> "s(?:ad|car(?:ed|y))"), so at each text
+# position the regex engine walks at most one keyword's length of trie rather
+# than trying every keyword in turn. Scanning is linear in the text length no
+# matter how large the lexicon grows.
+import re
+
+
+def trie_pattern(words):
+    """Regex source matching any of `words` (longest alternative first)."""
+    trie = {}
+    for word in words:
+        if not word:
+            continue
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        alt = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{alt})?" if "" in node else alt
+
+    return build(trie)
+
+
+class KeywordMatcher:
+    def __init__(self, mapping, ignore_case=False):
+        # mapping: keyword -> value reported (or substituted) for that keyword
+        self.ignore_case = ignore_case
+        self.mapping = {(k.lower() if ignore_case else k): v for k, v in mapping.items() if k}
+        source = trie_pattern(self.mapping) if self.mapping else r"(?!x)x"
+        flags = re.IGNORECASE if ignore_case else 0
+        self.pattern = re.compile(source, flags)
+        self._splitter = re.compile(f"({source})", flags)
+        # Zero-width lookahead reports a hit at every start position, including
+        # keywords that overlap another hit
+        self.overlapping = re.compile(f"(?=({source}))", flags)
+        # A hit on "fearful" is also a hit on "fear" if both are keywords; the
+        # regex only reports the longest, so credit every keyword prefix
+        self._prefix_values = {
+            k: frozenset(self.mapping[k[:i]] for i in range(1, len(k) + 1) if k[:i] in self.mapping)
+            for k in self.mapping
+        }
+
+    def _value(self, keyword):
+        return self.mapping[keyword.lower() if self.ignore_case else keyword]
+
+    def find_values(self, text):
+        """Set of values for every keyword occurring anywhere in text."""
+        values = set()
+        for m in self.overlapping.finditer(text):
+            hit = m.group(1)
+            values |= self._prefix_values[hit.lower() if self.ignore_case else hit]
+        return values
+
+    def sub(self, text, repl=None):
+        """Replace leftmost-longest keyword hits in one pass; by default each
+        keyword is replaced by its mapped value."""
+        if repl is not None:
+            return self.pattern.sub(repl, text)
+        # split() with a capturing group alternates [text, hit, text, hit, ...];
+        # mapping the hits with map() avoids a Python callback per match
+        parts = self._splitter.split(text)
+        if len(parts) > 1:
+            lookup = self._value if self.ignore_case else self.mapping.__getitem__
+            parts[1::2] = map(lookup, parts[1::2])
+        return "".join(parts)
@@ -0,0 +1,161 @@
+# lstm_backends.py
+# Interchangeable inference backends for SimpleLSTM:
+#
+#   eager        the fp32 nn.Module as trained
+#   int8         dynamic int8 quantization of the LSTM and output Linear
+#                (torch.ao quantize_dynamic: int8 weights, activations
+#                quantized on the fly), about a quarter of the weight memory
+#   torchscript  a scripted and frozen graph of the fp32 model
+#
+# Every backend exposes the same two operations the decoding loops need:
+# prefill(sequences, hidden) to run prompts through the LSTM and
+# step(idx, hidden) to advance every row by one token. Backends are built on
+# first use from the fp32 model and then shared by all requests.
+import copy
+import io
+import threading
+import warnings
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence
+
+from lstm_sampling import lstm_step
+
+BACKENDS = ("eager", "int8", "torchscript")
+ALIASES = {"fp32": "eager", "quantized": "int8", "qint8": "int8", "jit": "torchscript", "script": "torchscript"}
+
+
+def backend_name(name):
+    """Canonical backend name for `name` (or an alias); raises ValueError."""
+    key = (name or "").strip().lower()
+    key = ALIASES.get(key, key)
+    if key not in BACKENDS:
+        raise ValueError(f"unknown LSTM backend {name!r}; expected one of {', '.join(BACKENDS)}")
+    return key
+
+
+# --- Backends ---
+class LSTMBackend:
+    """The eager backend, and the base for the others. `model` is a
+    SimpleLSTM-shaped module (embed, lstm, fc)."""
+
+    def __init__(self, name, model):
+        self.name = name
+        self.model = model
+        self.num_layers = model.lstm.num_layers
+        self.hidden_size = model.lstm.hidden_size
+
+    def zeros(self, batch_size):
+        size = (self.num_layers, batch_size, self.hidden_size)
+        return torch.zeros(size), torch.zeros(size)
+
+    def prefill(self, sequences, hidden):
+        """Run each (non-empty) index list in `sequences` through the LSTM from
+        the matching rows of hidden=(h, c); returns the final (h, c)."""
+        model = self.model
+        if len(sequences) == 1:
+            _, hidden = model.lstm(model.embed(torch.tensor(sequences, dtype=torch.long)), hidden)
+            return hidden
+        lengths = [len(seq) for seq in sequences]
+        padded = torch.zeros(len(sequences), max(lengths), dtype=torch.long)
+        for row, seq in enumerate(sequences):
+            padded[row, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+        packed = pack_padded_sequence(model.embed(padded), lengths, batch_first=True, enforce_sorted=False)
+        _, hidden = model.lstm(packed, hidden)
+        return hidden
+
+    def step(self, idx, hidden):
+        return lstm_step(self.model, idx, hidden)
+
+    def weight_bytes(self):
+        # Serialized size, which also covers packed quantized weights
+        buf = io.BytesIO()
+        torch.save(self.model.state_dict(), buf)
+        return buf.tell()
+
+
+class QuantizedBackend(LSTMBackend):
+    # Steps call torch.quantized_lstm on the packed weights directly, skipping
+    # the quantized module's per-call argument checks and weight unpacking
+    def __init__(self, name, model):
+        super().__init__(name, model)
+        lstm = model.lstm
+        self._weights = [w.param for w in lstm._all_weight_values]
+        self._flags = (lstm.bias, lstm.num_layers, float(lstm.dropout), False, lstm.bidirectional, True)
+
+    def step(self, idx, hidden):
+        x = self.model.embed(idx).unsqueeze(1)
+        out, h, c = torch.quantized_lstm(x, list(hidden), self._weights, *self._flags, dtype=torch.qint8, use_dynamic=True)
+        return self.model.fc(out[:, -1]), (h, c)
+
+
+class ScriptedBackend(LSTMBackend):
+    # A frozen graph has no submodules left to call, so everything goes through forward()
+    def __init__(self, name, model, scripted):
+        super().__init__(name, model)
+        self._weight_bytes = super().weight_bytes()
+        self.model = scripted
+
+    def prefill(self, sequences, hidden):
+        # No packing through the graph: rows of equal length share one forward
+        h, c = hidden
+        h, c = h.clone(), c.clone()
+        by_length = {}
+        for row, seq in enumerate(sequences):
+            by_length.setdefault(len(seq), []).append(row)
+        for rows in by_length.values():
+            index = torch.tensor(rows, dtype=torch.long)
+            x = torch.tensor([sequences[row] for row in rows], dtype=torch.long)
+            _, (h[:, index], c[:, index]) = self.model(x, (h[:, index], c[:, index]))
+        return h, c
+
+    def step(self, idx, hidden):
+        out, hidden = self.model(idx.view(-1, 1), hidden)
+        return out[:, -1], hidden
+
+    def weight_bytes(self):
+        return self._weight_bytes
+
+
+def build_backend(model, name):
+    """Build backend `name` from the fp32 `model`, which is left untouched."""
+    name = backend_name(name)
+    if name == "eager":
+        return LSTMBackend(name, model)
+    with warnings.catch_warnings():
+        # torch flags its quantized-tensor and TorchScript APIs as deprecated
+        warnings.simplefilter("ignore")
+        if name == "int8":
+            quantized = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+            return QuantizedBackend(name, quantized.eval())
+        scripted = torch.jit.freeze(torch.jit.script(copy.deepcopy(model).eval()))
+        return ScriptedBackend(name, model, scripted)
+
+
+class BackendRegistry:
+    """Builds each backend once, on first use, from load_model()."""
+
+    def __init__(self, load_model, default="eager"):
+        self._load_model = load_model
+        self.default = backend_name(default)
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def get(self, name=None):
+        name = backend_name(name) if name else self.default
+        backend = self._backends.get(name)
+        if backend is None:
+            with self._lock:
+                backend = self._backends.get(name)
+                if backend is None:
+                    backend = self._backends[name] = build_backend(self._load_model(), name)
+        return backend
+
+    def install(self, backend):
+        """Serve an already built backend, e.g. one built before forking workers."""
+        with self._lock:
+            self._backends[backend.name] = backend
+
+    def loaded(self):
+        return list(self._backends)
@@ -0,0 +1,226 @@
+# lstm_batching.py
+# Dynamic micro-batching for SimpleLSTM sampling.
+#
+# Concurrent /generate calls submit their encoded prompts here instead of each
+# running its own batch-size-1 sampling loop. A single worker thread gathers
+# pending jobs (up to max_batch_size, waiting at most max_wait_ms for company),
+# steps the LSTM once per token for the whole batch (each row with its own
+# SamplingParams), and drops rows as they hit their own max_length. Jobs that arrive while a batch is running join it at
+# the next step, so the batch stays full under load.
+#
+# The batcher drives one LSTMBackend (see lstm_backends), so each inference
+# backend gets its own batcher and batches never mix backends.
+#
+# With a HiddenStateCache, jobs carrying a state_key resume from the cached
+# state of their conversation and store their final state when they finish.
+#
+# A job may carry a generation_budget.Budget: once it is exhausted (deadline
+# passed, client gone) or the job's future is cancelled, the row leaves the
+# batch at the next step with the tokens sampled so far, and a job still
+# queued is resolved without being prefilled.
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+import torch
+
+from generation_pool import WaitStats
+from lstm_sampling import BatchParams, SamplingParams, sample_next
+
+
+class GenerationJob:
+    __slots__ = ("input_idxs", "max_length", "params", "future", "generated", "queued_at", "on_token",
+                 "state_key", "initial_state", "sequence", "budget")
+
+    def __init__(self, input_idxs, max_length, params, on_token=None, state_key=None, initial_state=None,
+                 budget=None):
+        self.input_idxs = list(input_idxs)
+        self.max_length = max(0, int(max_length))
+        self.params = params
+        self.future = Future()
+        self.generated = self.input_idxs.copy()
+        self.queued_at = time.monotonic()
+        self.on_token = on_token
+        self.state_key = state_key
+        self.budget = budget
+        # (h, c) to start from; `sequence` is what the LSTM actually consumes,
+        # led by the cached last index when resuming a conversation
+        self.initial_state = None
+        self.sequence = self.input_idxs
+        if initial_state is not None:
+            h, c, last_idx = initial_state
+            self.initial_state = (h, c)
+            self.sequence = [last_idx] + self.input_idxs
+
+    def stopped(self):
+        # Cancelled by its caller or out of budget
+        return self.future.cancelled() or (self.budget is not None and self.budget.exhausted())
+
+    def finish(self):
+        try:
+            self.future.set_result(self.generated)
+        except InvalidStateError:
+            pass  # cancelled by its caller
+
+    def fail(self, exc):
+        try:
+            self.future.set_exception(exc)
+        except InvalidStateError:
+            pass  # already finished or cancelled
+
+
+class LSTMBatcher:
+    def __init__(self, backend, max_batch_size=16, max_wait_ms=5.0, state_cache=None):
+        self.backend = backend
+        self.state_cache = state_cache
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.waits = WaitStats()
+
+    def submit(self, input_idxs, max_length=100, params=None, on_token=None, state_key=None, budget=None):
+        """Queue one prompt (a list of vocab indices) with its SamplingParams;
+        returns a Future of the full index sequence (prompt + sampled tokens).
+        If given, on_token is
+        called from the worker thread with each sampled index, state_key
+        names the conversation whose hidden state is resumed and saved, and
+        budget can stop the job early (the sequence is then shorter)."""
+        if not input_idxs:
+            raise ValueError("input_idxs must not be empty")
+        if self.state_cache is None:
+            state_key = None
+        initial_state = self.state_cache.get(state_key) if state_key is not None else None
+        job = GenerationJob(input_idxs, max_length, params or SamplingParams(), on_token, state_key, initial_state,
+                            budget)
+        self._ensure_started()
+        self._queue.put(job)
+        return job.future
+
+    def stats(self):
+        return {
+            "backend": self.backend.name,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queue_depth": self._queue.qsize(),
+            "queue_wait": self.waits.snapshot(),
+        }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lstm-batcher", daemon=True)
+                self._thread.start()
+
+    # --- Scheduling ---
+    def _collect(self):
+        # Block for the first job, then wait up to max_wait for the batch to fill
+        jobs = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(jobs) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                jobs.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def _drain(self, limit):
+        jobs = []
+        while len(jobs) < limit:
+            try:
+                jobs.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            try:
+                self._generate(jobs)
+            except Exception as e:  # never let the worker thread die
+                for job in jobs:
+                    job.fail(e)
+
+    # --- Batched generation ---
+    def _prefill(self, jobs):
+        # Encode every prompt except its last character; that character becomes
+        # the first input of the step loop, so prompt and decode share one path.
+        now = time.monotonic()
+        for job in jobs:
+            self.waits.record(now - job.queued_at)
+        h, c = self.backend.zeros(len(jobs))
+        for i, job in enumerate(jobs):
+            if job.initial_state is not None:
+                h[:, i:i + 1], c[:, i:i + 1] = job.initial_state
+        rows = [i for i, job in enumerate(jobs) if len(job.sequence) > 1]
+        if rows:
+            index = torch.tensor(rows, dtype=torch.long)
+            ph, pc = self.backend.prefill([jobs[i].sequence[:-1] for i in rows], (h[:, index], c[:, index]))
+            h[:, index] = ph
+            c[:, index] = pc
+        last = torch.tensor([job.sequence[-1] for job in jobs], dtype=torch.long)
+        return h, c, last
+
+    def _generate(self, jobs):
+        # `jobs` is extended with every job that joins mid-batch, so the caller
+        # can fail all of them if a step raises
+        active = self._startable(jobs)
+        if not active:
+            return
+        with torch.inference_mode():
+            h, c, last = self._prefill(active)
+            params = BatchParams.stack([job.params for job in active])
+            remaining = [job.max_length for job in active]
+            while active:
+                logits, (h, c) = self.backend.step(last, (h, c))
+                last = sample_next(logits, params)
+                keep = []
+                for i, idx in enumerate(last.tolist()):
+                    job = active[i]
+                    job.generated.append(idx)
+                    remaining[i] -= 1
+                    if job.on_token is not None:
+                        try:
+                            job.on_token(idx)
+                        except Exception as e:
+                            # A failing callback fails its own job, not the batch
+                            job.fail(e)
+                            continue
+                    if remaining[i] > 0 and not job.stopped():
+                        keep.append(i)
+                    else:
+                        if job.state_key is not None:
+                            self.state_cache.put(job.state_key, h[:, i:i + 1].clone(), c[:, i:i + 1].clone(), idx)
+                        job.finish()
+                if len(keep) < len(active):
+                    index = torch.tensor(keep, dtype=torch.long)
+                    active = [active[i] for i in keep]
+                    remaining = [remaining[i] for i in keep]
+                    h, c, last, params = h[:, index], c[:, index], last[index], params.select(index)
+                # Let newly arrived jobs join at the next step
+                room = self.max_batch_size - len(active)
+                newcomers = self._startable(self._drain(room)) if room > 0 else []
+                if newcomers:
+                    jobs.extend(newcomers)
+                    nh, nc, nlast = self._prefill(newcomers)
+                    h, c = torch.cat([h, nh], dim=1), torch.cat([c, nc], dim=1)
+                    last = torch.cat([last, nlast])
+                    params = params.cat(BatchParams.stack([job.params for job in newcomers]))
+                    active.extend(newcomers)
+                    remaining.extend(job.max_length for job in newcomers)
+
+    def _startable(self, jobs):
+        # Resolve jobs with nothing to sample, or stopped while they queued
+        startable = []
+        for job in jobs:
+            if job.max_length == 0 or job.stopped():
+                job.finish()
+            else:
+                startable.append(job)
+        return startable
@@ -0,0 +1,61 @@
+# lstm_model.py
+# SimpleLSTM, its character vocabulary and the checkpoint format.
+#
+# A checkpoint is a torch.save'd dict:
+#   {"config": {"vocab": str, "hidden_size": int, "num_layers": int},
+#    "state_dict": {...}}
+# load_checkpoint memory-maps it (torch.load(mmap=True, weights_only=True)) and
+# load_state_dict(assign=True) adopts the mapped tensors instead of copying
+# them, so loading is near-instant and every worker on the host shares the same
+# page-cache copy of the weights.
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+# Dummy vocabulary and model for demonstration
+VOCAB = list("abcdefghijklmnopqrstuvwxyz .,!?\n")
+CHAR2IDX = {c: i for i, c in enumerate(VOCAB)}
+IDX2CHAR = {i: c for i, c in enumerate(VOCAB)}
+VOCAB_SIZE = len(VOCAB)
+
+class SimpleLSTM(nn.Module):
+    def __init__(self, vocab_size, hidden_size=128, num_layers=1):
+        super().__init__()
+        self.embed = nn.Embedding(vocab_size, hidden_size)
+        self.lstm = nn.LSTM(hidden_size, hidden_size, num_layers, batch_first=True)
+        self.fc = nn.Linear(hidden_size, vocab_size)
+
+    def forward(self, x, hidden: Optional[Tuple[torch.Tensor, torch.Tensor]] = None):
+        x = self.embed(x)
+        out, hidden = self.lstm(x, hidden)
+        out = self.fc(out)
+        return out, hidden
+
+
+def model_config(model, vocab=VOCAB):
+    return {"vocab": "".join(vocab), "hidden_size": model.lstm.hidden_size, "num_layers": model.lstm.num_layers}
+
+
+def save_checkpoint(model, path, vocab=VOCAB, **extra):
+    # extra entries (e.g. training step, optimizer state) ride along untouched
+    torch.save({"config": model_config(model, vocab), "state_dict": model.state_dict(), **extra}, path)
+
+
+def load_checkpoint(path, vocab=VOCAB):
+    """Build an eval-mode SimpleLSTM whose weights are memory-mapped from the
+    checkpoint at `path`. Raises ValueError if it was trained on another vocab."""
+    checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    config = checkpoint["config"]
+    if config["vocab"] != "".join(vocab):
+        raise ValueError(f"checkpoint {path} was trained on a different vocabulary")
+    # Not built on the meta device: that drags in torch._refs, over a second of
+    # imports, while the throwaway init at this size takes a millisecond or two
+    model = SimpleLSTM(len(config["vocab"]), config["hidden_size"], config["num_layers"])
+    model.load_state_dict(checkpoint["state_dict"], assign=True)
+    return model.eval()
+
+
+def load_model(path=None, vocab=VOCAB):
+    # The checkpoint at `path`, or a randomly initialised demo model
+    return load_checkpoint(path, vocab) if path else SimpleLSTM(len(vocab)).eval()
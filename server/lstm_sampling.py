@@ -0,0 +1,117 @@
+# lstm_sampling.py
+# Next-token selection for SimpleLSTM, shared by the batched and unbatched
+# decoding loops. Everything stays in torch: one softmax and one multinomial
+# draw per step for the whole batch, with per-row temperature, top-k, top-p
+# (nucleus) and greedy settings. lstm_step is the matching single-token
+# forward pass used once the prompt has been prefilled.
+import math
+
+import torch
+import torch.nn.functional as F
+
+# Below this, logits / temperature overflows float32 to inf and the softmax
+# turns to NaN; sampling this sharp is argmax in practice anyway
+MIN_TEMPERATURE = 1e-3
+
+
+class SamplingParams:
+    __slots__ = ("temperature", "top_k", "top_p", "greedy")
+
+    def __init__(self, temperature=1.0, top_k=None, top_p=None, greedy=False):
+        temperature = 1.0 if temperature is None else float(temperature)
+        if not math.isfinite(temperature):
+            raise ValueError(f"temperature must be a finite number, got {temperature}")
+        # temperature 0 is the limit of sharpening, i.e. argmax
+        self.greedy = bool(greedy) or temperature <= 0
+        self.temperature = max(temperature, MIN_TEMPERATURE) if temperature > 0 else 1.0
+        self.top_k = int(top_k) if top_k and top_k > 0 else 0
+        self.top_p = float(top_p) if top_p is not None and 0 < top_p < 1 else 1.0
+
+    @property
+    def filtered(self):
+        return self.top_k > 0 or self.top_p < 1.0
+
+
+class BatchParams:
+    # Column tensors of SamplingParams for the rows of a batch
+    def __init__(self, temperature, top_k, top_p, greedy):
+        self.temperature = temperature  # [B, 1] float
+        self.top_k = top_k              # [B, 1] long, 0 = off
+        self.top_p = top_p              # [B, 1] float, 1.0 = off
+        self.greedy = greedy            # [B] bool
+        self.any_greedy = bool(greedy.any())
+        self.all_greedy = bool(greedy.all())
+        self.any_top_p = bool((top_p < 1.0).any())
+        self.any_filter = self.any_top_p or bool((top_k > 0).any())
+
+    @classmethod
+    def stack(cls, params):
+        return cls(
+            torch.tensor([[p.temperature] for p in params]),
+            torch.tensor([[p.top_k] for p in params], dtype=torch.long),
+            torch.tensor([[p.top_p] for p in params]),
+            torch.tensor([p.greedy for p in params], dtype=torch.bool),
+        )
+
+    def select(self, index):
+        return BatchParams(self.temperature[index], self.top_k[index], self.top_p[index], self.greedy[index])
+
+    def cat(self, other):
+        return BatchParams(
+            torch.cat([self.temperature, other.temperature]),
+            torch.cat([self.top_k, other.top_k]),
+            torch.cat([self.top_p, other.top_p]),
+            torch.cat([self.greedy, other.greedy]),
+        )
+
+
+def lstm_step(model, idx, hidden):
+    """Advance `model` by one token per row: idx is [B], hidden is (h, c)
+    shaped [layers, B, H]. Returns (logits [B, V], (h, c)).
+
+    For a single step nn.LSTM's sequence machinery costs far more than the
+    math, so plain LSTM weights are driven through torch.lstm_cell directly;
+    anything else (e.g. quantized or scripted modules) uses forward()."""
+    lstm = model.lstm
+    if hidden is None or not isinstance(lstm, torch.nn.LSTM) or lstm.bidirectional or lstm.proj_size or not lstm.bias:
+        out, hidden = model(idx.view(-1, 1), hidden)
+        return out[:, -1], hidden
+    h, c = hidden
+    x = model.embed(idx)
+    hs, cs = [], []
+    for layer in range(lstm.num_layers):
+        hl, cl = torch.lstm_cell(
+            x, (h[layer], c[layer]),
+            getattr(lstm, f"weight_ih_l{layer}"), getattr(lstm, f"weight_hh_l{layer}"),
+            getattr(lstm, f"bias_ih_l{layer}"), getattr(lstm, f"bias_hh_l{layer}"),
+        )
+        hs.append(hl)
+        cs.append(cl)
+        x = hl
+    return model.fc(x), (torch.stack(hs), torch.stack(cs))
+
+
+def sample_next(logits, params, generator=None):
+    """Pick one index per row of `logits` ([B, V]) according to `params`
+    (a BatchParams); returns a LongTensor of shape [B]."""
+    if params.all_greedy:
+        return logits.argmax(dim=-1)
+    scaled = logits / params.temperature
+    if params.any_filter and not params.any_top_p:
+        # top-k only: drop everything below each row's k-th largest logit
+        k = params.top_k.clamp(min=1, max=logits.shape[-1])
+        kth = scaled.topk(int(k.max()), dim=-1).values.gather(-1, k - 1)
+        scaled = scaled.masked_fill((params.top_k > 0) & (scaled < kth), float("-inf"))
+    elif params.any_filter:
+        # Filter in sorted order, then scatter back; the top token always survives
+        sorted_logits, order = scaled.sort(dim=-1, descending=True)
+        ranks = torch.arange(logits.shape[-1]).unsqueeze(0)
+        remove = (params.top_k > 0) & (ranks >= params.top_k)
+        sorted_probs = F.softmax(sorted_logits, dim=-1)
+        remove |= (sorted_probs.cumsum(dim=-1) - sorted_probs) > params.top_p
+        scaled = torch.empty_like(scaled).scatter_(-1, order, sorted_logits.masked_fill(remove, float("-inf")))
+    probs = F.softmax(scaled, dim=-1)
+    idx = torch.multinomial(probs, 1, generator=generator).view(-1)
+    if params.any_greedy:
+        idx = torch.where(params.greedy, logits.argmax(dim=-1), idx)
+    return idx
@@ -0,0 +1,78 @@
+# lstm_state_cache.py
+# Per-conversation cache of SimpleLSTM hidden states.
+#
+# After a turn finishes we keep the final (h, c) together with the last sampled
+# index (which the LSTM has not consumed yet). The next turn of the same
+# conversation starts from that state and only feeds its own new text through
+# the model; on a miss it falls back to a full prefill from a zero state.
+import threading
+import time
+from collections import OrderedDict
+
+
+class HiddenStateCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl_seconds=1800.0):
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl = float(ttl_seconds)
+        self._entries = OrderedDict()  # key -> (h, c, last_idx, expires_at, nbytes)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return (h, c, last_idx) for key, or None on a miss or expired entry."""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[3] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1], entry[2]
+
+    def put(self, key, h, c, last_idx):
+        if key is None:
+            return
+        nbytes = h.element_size() * h.nelement() + c.element_size() * c.nelement()
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (h, c, int(last_idx), time.monotonic() + self.ttl, nbytes)
+            self.bytes += nbytes
+            self._evict()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[4]
+
+    def _evict(self):
+        now = time.monotonic()
+        # Expired entries first (oldest-used first), then LRU until within budget
+        for key in [k for k, e in self._entries.items() if e[3] < now]:
+            self._drop(key)
+            self.evictions += 1
+        while self.bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
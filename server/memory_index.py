@@ -0,0 +1,193 @@
+# memory_index.py
+# Per-conversation long-term memory with relevance-ranked recall.
+#
+# The state store holds the memory itself: one document per remembered entry
+# (namespace "memory_entry", key (user_id, character_id, id)) and a small
+# header {"first": oldest live id, "next": next id} under "memory_index". Ids
+# only grow, so an entry never changes once written. The header is rewritten
+# every turn; entries should be stored as owned by it (state_store `owned`), so
+# they are not lost to the store's TTL while the conversation is active and are
+# purged with the header once it goes quiet.
+#
+# Each worker keeps a BM25 inverted index per conversation in a bounded LRU.
+# recall() reads the header and fetches only the entries its index has not
+# seen yet (usually the one remembered on the previous turn, possibly by
+# another worker); a cold index loads the live entries in one read. Scoring
+# touches just the postings of the query's terms, with NumPy, and returns the
+# top-k entries; recency breaks ties and fills up when few entries match.
+#
+# At most max_entries entries of at most max_chars characters are kept; the
+# oldest are deleted from the store as new ones arrive. In the index, evicted
+# ids are skipped when postings are read and swept out once they make up a
+# quarter of the cap, so memory and recall latency stay bounded however long
+# the conversation runs.
+import math
+import re
+import threading
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+TOKEN = re.compile(r"[a-z0-9']+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by do for from had has have he her him his how i i'm if in is it it's its "
+    "me my of on or our she so that the their them then there they this to too us was we were what when "
+    "where which who why will with you your".split()
+)
+
+
+def terms(text):
+    return [t for t in TOKEN.findall(text.lower()) if t not in STOPWORDS]
+
+
+class ConversationIndex:
+    """BM25 index over entries first..next-1 of one conversation."""
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, first=0):
+        self.first = first
+        self.next = first
+        # Compact arrays, read by NumPy without copying
+        self.texts = []  # entry first + i at position i
+        self.lens = array("d")
+        self.post = {}  # term -> array of id, tf, id, tf, ... in id order
+        self.stale = 0
+        self.lock = threading.Lock()
+
+    def add(self, entry_id, text):
+        counts = {}
+        for word in terms(text):
+            counts[word] = counts.get(word, 0) + 1
+        for word, tf in counts.items():
+            posting = self.post.get(word)
+            if posting is None:
+                posting = self.post[word] = array("q")
+            posting.extend((entry_id, tf))
+        self.texts.append(text)
+        self.lens.append(sum(counts.values()))
+        self.next = entry_id + 1
+
+    def evict(self, first, max_entries):
+        excess = first - self.first
+        if excess <= 0:
+            return
+        del self.texts[:excess]
+        del self.lens[:excess]
+        self.first = first
+        self.stale += excess
+        if self.stale * 4 >= max_entries:
+            # Drop postings of evicted entries, and terms left with none
+            post = {}
+            for word, posting in self.post.items():
+                if posting[-2] >= first:
+                    start = int(np.searchsorted(np.frombuffer(posting, dtype=np.int64)[0::2], first))
+                    post[word] = posting[2 * start:]
+            self.post = post
+            self.stale = 0
+
+    def top(self, query, k):
+        count = len(self.texts)
+        if count <= k:
+            return list(self.texts)
+        # Live postings of every query term, scored together
+        hits, idfs = [], []
+        for term in set(terms(query)):
+            posting = self.post.get(term)
+            if not posting:
+                continue
+            pairs = np.frombuffer(posting, dtype=np.int64).reshape(-1, 2)
+            pairs = pairs[np.searchsorted(pairs[:, 0], self.first):]
+            # A term in most entries barely moves BM25 scores; skip its long posting
+            if 0 < len(pairs) <= count // 2:
+                hits.append(pairs)
+                idfs.append(math.log(1 + (count - len(pairs) + 0.5) / (len(pairs) + 0.5)))
+        if not hits:
+            return self.texts[-k:]
+        lens = np.frombuffer(self.lens, dtype=np.float64)
+        norm = self.K1 * (1 - self.B + self.B * lens / (lens.mean() or 1.0))
+        # Recency breaks ties, and ranks entries that match no query term
+        scores = np.arange(count, dtype=np.float64) * (1e-9 / count)
+        pairs = np.concatenate(hits)
+        rows, tf = pairs[:, 0] - self.first, pairs[:, 1].astype(np.float64)
+        idf = np.repeat(idfs, [len(h) for h in hits])
+        scores += np.bincount(rows, idf * tf * (self.K1 + 1) / (tf + norm[rows]), count)
+        best = np.argpartition(scores, count - k)[count - k:]
+        return [self.texts[i] for i in np.sort(best)]
+
+
+class MemoryIndex:
+    namespace = "memory_index"
+    entry_namespace = "memory_entry"
+
+    def __init__(self, max_entries=1000, max_chars=500, top_k=5, cache_size=256):
+        self.max_entries = max(1, int(max_entries))
+        self.max_chars = max(1, int(max_chars))
+        self.top_k = max(0, int(top_k))
+        self.cache_size = max(1, int(cache_size))
+        self._indexes = OrderedDict()  # (user_id, character_id) -> ConversationIndex
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def key(self, user_id, character_id):
+        return (self.namespace, (user_id, character_id))
+
+    def _entry_key(self, user_id, character_id, entry_id):
+        return (self.entry_namespace, (user_id, character_id, entry_id))
+
+    def _index(self, conversation):
+        with self._lock:
+            index = self._indexes.get(conversation)
+            if index is not None:
+                self._indexes.move_to_end(conversation)
+            return index
+
+    def _sync(self, state, user_id, character_id):
+        # The conversation's index, brought up to date with the store
+        conversation = (user_id, character_id)
+        header = state.get(self.namespace, conversation) or {"first": 0, "next": 0}
+        first, nxt = header["first"], header["next"]
+        index = self._index(conversation)
+        if index is None or index.next > nxt or index.next < first:
+            # Cold, or out of step with the store (e.g. a write rolled back)
+            index = ConversationIndex(first)
+            with self._lock:
+                self.loads += 1
+                self._indexes[conversation] = index
+                while len(self._indexes) > self.cache_size:
+                    self._indexes.popitem(last=False)
+        with index.lock:
+            if index.next < nxt:
+                keys = [self._entry_key(user_id, character_id, i) for i in range(index.next, nxt)]
+                state.prefetch(keys)
+                for entry_id, (ns, key) in zip(range(index.next, nxt), keys):
+                    index.add(entry_id, state.get(ns, key, ""))
+            index.evict(first, self.max_entries)
+        return index
+
+    def recall(self, state, user_id, character_id, query, k=None):
+        """The k remembered entries most relevant to `query`, oldest first."""
+        k = self.top_k if k is None else k
+        if not k:
+            return []
+        index = self._sync(state, user_id, character_id)
+        with index.lock:
+            # An entry evicted from an in-memory store's budget is indexed as ""
+            return [text for text in index.top(query, k) if text]
+
+    def remember(self, state, user_id, character_id, entry):
+        conversation = (user_id, character_id)
+        header = state.get(self.namespace, conversation) or {"first": 0, "next": 0}
+        first, nxt = header["first"], header["next"]
+        state.set(*self._entry_key(user_id, character_id, nxt), entry[:self.max_chars])
+        nxt += 1
+        # Delete what falls out of the cap
+        for old in range(first, max(first, nxt - self.max_entries)):
+            state.set(*self._entry_key(user_id, character_id, old), None)
+        first = max(first, nxt - self.max_entries)
+        state.set(self.namespace, conversation, {"first": first, "next": nxt})
+
+    def stats(self):
+        return {"max_entries": self.max_entries, "max_chars": self.max_chars, "top_k": self.top_k,
+                "cached_conversations": len(self._indexes), "cache_size": self.cache_size, "loads": self.loads}
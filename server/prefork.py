@@ -0,0 +1,159 @@
+# prefork.py
+# Multi-process serving for deepgen_service_lstm with one copy of the weights.
+#
+#   python prefork.py --workers 4 --port 8000
+#
+# `uvicorn --workers N` has every worker import the app and build its own
+# model and backend, each using all cores. Here the parent loads the model
+# (memory-mapped from DEEPGEN_CHECKPOINT, or the random demo model), builds the
+# default backend (so int8/torchscript weights are shared too), binds the
+# listening socket and then forks. Workers only read the weights, so those
+# pages stay shared; each worker runs its own uvicorn server on the inherited
+# socket and the kernel spreads connections between them.
+#
+# Each worker gets a thread budget instead of torch's all-cores default:
+#   DEEPGEN_INTRAOP_THREADS  intra-op threads (default: cores // workers, >= 1)
+#   DEEPGEN_INTEROP_THREADS  inter-op threads (default 1)
+#   DEEPGEN_PIN_CORES=1      pin worker i to its own block of intra-op cores
+# The generation pool of each worker defaults to the same intra-op budget.
+# A worker that exits unexpectedly is restarted; SIGTERM/SIGINT stop them all.
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+
+import torch
+
+from lstm_backends import build_backend
+from lstm_model import load_model
+from tokenizer import get_tokenizer
+
+
+def thread_budget(workers):
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    intra = int(os.environ.get("DEEPGEN_INTRAOP_THREADS", "0")) or max(1, cores // max(1, workers))
+    inter = int(os.environ.get("DEEPGEN_INTEROP_THREADS", "0")) or 1
+    return intra, inter
+
+
+def worker_cores(index, intra):
+    # Worker `index`'s block of `intra` cores, wrapping around when there are
+    # more threads than cores
+    cores = sorted(os.sched_getaffinity(0))
+    return {cores[(index * intra + i) % len(cores)] for i in range(intra)}
+
+
+def configure_threads(intra, inter, cores=None):
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(intra)
+    try:
+        torch.set_num_interop_threads(inter)
+    except RuntimeError:
+        pass  # the inter-op pool already started; keep its size
+
+
+def preload():
+    """Load the model and build the default backend the way the service
+    would, for the workers to share."""
+    # Single-threaded, so no OpenMP thread pool exists at fork time: GNU
+    # OpenMP's pool does not survive fork(), and a worker that inherits one
+    # hangs on its first parallel op (building int8/torchscript backends runs
+    # some). Workers set their own thread budget after the fork.
+    torch.set_num_threads(1)
+    tokenizer = get_tokenizer(os.environ.get("DEEPGEN_TOKENIZER", "char"))
+    model = load_model(os.environ.get("DEEPGEN_CHECKPOINT"), tokenizer.vocab)
+    backend = build_backend(model, os.environ.get("DEEPGEN_LSTM_BACKEND", "eager"))
+    return model, backend
+
+
+def run_worker(index, workers, sock, model, backend, args):
+    intra, inter = thread_budget(workers)
+    configure_threads(intra, inter, worker_cores(index, intra) if args.pin_cores else None)
+    os.environ.setdefault("DEEPGEN_POOL_WORKERS", str(intra))
+
+    import uvicorn
+    import deepgen_service_lstm as svc
+
+    svc.install_model(model, backend)
+    config = uvicorn.Config(svc.app, log_level=args.log_level, access_log=False)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def bind(host, port):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve(args):
+    model, backend = preload()
+    sock = bind(args.host, args.port)
+    children = {}  # pid -> worker index
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                run_worker(index, args.workers, sock, model, backend, args)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    intra, inter = thread_budget(args.workers)
+    print(f"prefork: {args.workers} workers on {args.host}:{args.port}, {intra} intra-op / {inter} inter-op "
+          f"threads each{', pinned' if args.pin_cores else ''}", file=sys.stderr, flush=True)
+    for index in range(args.workers):
+        spawn(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print(f"prefork: worker {index} (pid {pid}) exited with status {status}; restarting",
+                  file=sys.stderr, flush=True)
+            time.sleep(1.0)  # don't spin if workers die at startup
+            spawn(index)
+    sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python prefork.py", description="Serve deepgen_service_lstm from forked workers")
+    parser.add_argument("--host", default=os.environ.get("DEEPGEN_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("DEEPGEN_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("DEEPGEN_WORKERS", "0")) or (os.cpu_count() or 1))
+    parser.add_argument("--pin-cores", action="store_true", default=os.environ.get("DEEPGEN_PIN_CORES", "0") == "1")
+    parser.add_argument("--log-level", default="warning")
+    serve(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
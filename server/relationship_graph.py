@@ -0,0 +1,106 @@
+# relationship_graph.py
+# Character relationships as an undirected weighted graph in the state store.
+#
+# Each node (a character or user id) has one adjacency document in the
+# "relationships" namespace: {"e": {neighbor: [strength, updated_at]}}. Both
+# endpoints of an edge hold it, so the whole neighborhood of a node is a single
+# prefetched read: listing neighbors and picking the top-k strongest ties never
+# scans other nodes' edges.
+#
+# Strengths decay with a half-life, computed lazily: an edge stores the
+# strength it had when last updated and its age is applied when it is read, so
+# nothing ever sweeps the graph. An update folds the decay in before adding
+# its delta.
+#
+# Memory is bounded per node: once a node has max_degree neighbors, adding
+# another drops its weakest tie (smallest decayed |strength|) from both ends.
+# The namespace must be persistent in the state store: a tie fades with its
+# half-life, not with the store's TTL, which would cut off a strong tie that
+# simply went a week without feedback. Give it an entry budget instead to
+# bound the number of nodes: an evicted node loses its own document, and the
+# neighbors that still list it drop it as they fill up.
+import heapq
+import time
+
+
+class RelationshipGraph:
+    namespace = "relationships"
+
+    def __init__(self, half_life_seconds=30 * 24 * 3600.0, max_degree=256, clock=time.time):
+        self.half_life = max(0.0, float(half_life_seconds))
+        self.max_degree = max(1, int(max_degree))
+        self.clock = clock
+
+    def keys(self, *nodes):
+        return [(self.namespace, node) for node in nodes if node]
+
+    def decayed(self, edge, now):
+        strength, updated = edge
+        if not self.half_life or now <= updated:
+            return strength
+        return strength * 0.5 ** ((now - updated) / self.half_life)
+
+    def _edges(self, state, node):
+        return state.get(self.namespace, node, {}).get("e", {})
+
+    # --- Reads ---
+    def get(self, state, char1, char2):
+        edge = self._edges(state, char1).get(char2)
+        return round(self.decayed(edge, self.clock()), 3) if edge else 0
+
+    def neighbors(self, state, node):
+        """{neighbor: current strength} for every tie of `node`."""
+        now = self.clock()
+        return {other: round(self.decayed(edge, now), 3) for other, edge in self._edges(state, node).items()}
+
+    def strongest(self, state, node, k=10):
+        """The k ties of `node` with the largest |strength|, strongest first,
+        as (neighbor, strength) pairs."""
+        now = self.clock()
+        current = ((other, self.decayed(edge, now)) for other, edge in self._edges(state, node).items())
+        return [(other, round(s, 3)) for other, s in heapq.nlargest(k, current, key=lambda item: abs(item[1]))]
+
+    # --- Writes ---
+    def update(self, state, char1, char2, delta):
+        self.update_many(state, [(char1, char2, delta)])
+
+    def update_many(self, state, deltas):
+        """Apply (char1, char2, delta) triples, e.g. a batch of feedback.
+        Every touched node is read and written once."""
+        merged = {}
+        for char1, char2, delta in deltas:
+            if delta and char1 and char2 and char1 != char2:
+                pair = (char1, char2) if char1 < char2 else (char2, char1)
+                merged[pair] = merged.get(pair, 0) + delta
+        if not merged:
+            return
+        nodes = {node for pair in merged for node in pair}
+        state.prefetch(self.keys(*nodes))
+        docs = {node: {"e": dict(self._edges(state, node))} for node in nodes}
+        now = self.clock()
+        # Stored compactly: strength to 4 decimals, update time in whole seconds
+        stamp = int(now)
+        for (a, b), delta in merged.items():
+            edge = docs[a]["e"].get(b) or docs[b]["e"].get(a)
+            strength = round((self.decayed(edge, now) if edge else 0) + delta, 4)
+            docs[a]["e"][b] = docs[b]["e"][a] = [strength, stamp]
+        for node in list(docs):
+            self._trim(state, docs, node, now)
+        for node, doc in docs.items():
+            state.set(self.namespace, node, doc)
+
+    def _trim(self, state, docs, node, now):
+        # Drop the weakest ties of an over-full node from both of their ends
+        edges = docs[node]["e"]
+        excess = len(edges) - self.max_degree
+        if excess <= 0:
+            return
+        weakest = heapq.nsmallest(excess, edges, key=lambda other: abs(self.decayed(edges[other], now)))
+        for other in weakest:
+            del edges[other]
+            if other not in docs:
+                docs[other] = {"e": dict(self._edges(state, other))}
+            docs[other]["e"].pop(node, None)
+
+    def stats(self):
+        return {"half_life_seconds": self.half_life, "max_degree": self.max_degree}
@@ -0,0 +1,311 @@
+# state_store.py
+# Conversation state backends for the narrative, memory, relationship and
+# personality managers.
+#
+# Values are JSON documents addressed by (namespace, key). A request opens one
+# StateSession: it prefetches every key it needs in a single read, works on
+# local copies, and flushes all writes in a single batch when it closes.
+#
+# MemoryStateStore is a bounded LRU with TTL for single-process use.
+# SQLiteStateStore is durable (WAL mode) and shared by every worker on the
+# host; it keeps a MemoryStateStore in front as a read cache, dropped whenever
+# another connection has committed (PRAGMA data_version changed).
+#
+# Namespaces listed as `persistent` (e.g. registered character profiles) are
+# exempt from the TTL. A namespace can also get its own LRU budget in a
+# MemoryStateStore (`budgets`: max entries, None = never evicted), so it
+# neither crowds out nor is crowded out by the rest; the memory backend evicts
+# a persistent namespace only when it is given a budget.
+#
+# `owned` maps a namespace to its owner namespace, for documents that belong
+# to another one (e.g. a conversation's memory entries, keyed (user, character,
+# id), and its header, keyed (user, character)). Owned documents are never
+# rewritten just to stay alive: they are exempt from the TTL and purged
+# together with their owner when it expires. Setting a value to None deletes it.
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+def make_key(key):
+    # Tuple keys such as (user_id, character_id) become one string column
+    if isinstance(key, (tuple, list)):
+        return "\x1f".join(str(part) for part in key)
+    return str(key)
+
+
+class StateSession:
+    def __init__(self, store):
+        self.store = store
+        self._values = {}  # (namespace, key) -> decoded value or None
+        self._dirty = set()
+
+    def prefetch(self, items):
+        """Load all (namespace, key) pairs not yet seen in one backend call."""
+        wanted = [(ns, make_key(k)) for ns, k in items]
+        wanted = [item for item in dict.fromkeys(wanted) if item not in self._values]
+        if wanted:
+            found = self.store.get_many(wanted)
+            for item in wanted:
+                raw = found.get(item)
+                self._values[item] = json.loads(raw) if raw is not None else None
+
+    def get(self, namespace, key, default=None):
+        item = (namespace, make_key(key))
+        if item not in self._values:
+            self.prefetch([(namespace, key)])
+        value = self._values[item]
+        return default if value is None else value
+
+    def set(self, namespace, key, value):
+        item = (namespace, make_key(key))
+        self._values[item] = value
+        self._dirty.add(item)
+
+    def flush(self):
+        if self._dirty:
+            self.store.put_many({item: None if self._values[item] is None else json.dumps(self._values[item])
+                                 for item in self._dirty})
+            self._dirty.clear()
+
+
+class _SessionScope:
+    def __init__(self, store):
+        self.store = store
+        self.session = StateSession(store)
+
+    def __enter__(self):
+        self.store.begin()
+        return self.session
+
+    def __exit__(self, exc_type, exc, tb):
+        commit = exc_type is None
+        try:
+            if commit:
+                self.session.flush()
+        except BaseException:
+            commit = False  # never commit a partly written batch
+            raise
+        finally:
+            self.store.end(commit=commit)
+        return False
+
+
+class MemoryStateStore:
+    def __init__(self, max_entries=100_000, ttl_seconds=7 * 24 * 3600.0, persistent=(), budgets=None):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl_seconds)
+        self.persistent = frozenset(persistent)
+        self.budgets = {ns: None if limit is None else max(1, int(limit)) for ns, limit in (budgets or {}).items()}
+        self._entries = OrderedDict()  # (namespace, key) -> (json, expires_at)
+        self._own = {ns: OrderedDict() for ns in self.budgets}  # the same, for namespaces with a budget
+        self._lock = threading.RLock()
+        self.evictions = 0
+
+    def session(self):
+        return _SessionScope(self)
+
+    def begin(self):
+        self._lock.acquire()
+
+    def end(self, commit=True):
+        self._lock.release()
+
+    def get_many(self, items):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for item in items:
+                entries = self._own.get(item[0], self._entries)
+                entry = entries.get(item)
+                if entry is None:
+                    continue
+                if entry[1] < now:
+                    del entries[item]
+                    continue
+                entries.move_to_end(item)
+                found[item] = entry[0]
+        return found
+
+    def put_many(self, values, ages=None):
+        # `ages`: seconds since each value was written, when it was written earlier
+        # (a row loaded from disk), so it expires with the copy of record
+        expires = time.monotonic() + self.ttl
+        ages = ages or {}
+        with self._lock:
+            for item, raw in values.items():
+                entries = self._own.get(item[0], self._entries)
+                if raw is None:
+                    entries.pop(item, None)
+                    continue
+                entries[item] = (raw, float("inf") if item[0] in self.persistent else expires - ages.get(item, 0.0))
+                entries.move_to_end(item)
+            self._evict(self._entries, self.max_entries)
+            for ns, entries in self._own.items():
+                self._evict(entries, self.budgets[ns])
+
+    def _evict(self, entries, limit):
+        while limit is not None and len(entries) > limit:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for entries in self._own.values():
+                entries.clear()
+
+    def __len__(self):
+        return len(self._entries) + sum(len(entries) for entries in self._own.values())
+
+    def stats(self):
+        return {"backend": "memory", "entries": len(self), "max_entries": self.max_entries,
+                "budgets": {ns: {"entries": len(self._own[ns]), "max_entries": limit} for ns, limit in self.budgets.items()},
+                "ttl_seconds": self.ttl, "evictions": self.evictions}
+
+
+class SQLiteStateStore:
+    PURGE_EVERY = 1000  # sessions between TTL sweeps of the table
+
+    def __init__(self, path, cache_entries=100_000, ttl_seconds=7 * 24 * 3600.0, persistent=(), budgets=None,
+                 owned=None):
+        self.path = path
+        self.ttl = float(ttl_seconds)
+        self.owned = dict(owned or {})
+        self.persistent = frozenset(persistent) | frozenset(self.owned)
+        # The table is the copy of record, so every namespace in the cache may be evicted
+        self.cache = MemoryStateStore(cache_entries, ttl_seconds, self.persistent,
+                                      budgets={ns: limit for ns, limit in (budgets or {}).items() if limit is not None})
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated REAL NOT NULL,"
+            " PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS state_updated ON state (updated)")
+        self._lock = threading.RLock()
+        self._data_version = None
+        self._sessions = 0
+        # Row count as of opening or the last purge: len() is read by metrics
+        # scrapes, and COUNT(*) scans the whole table
+        self.rows = self._count()
+
+    def session(self):
+        return _SessionScope(self)
+
+    def begin(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so the read-modify-write
+        # of one request cannot interleave with another worker's
+        self._lock.acquire()
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if version != self._data_version:
+                self.cache.clear()
+                self._data_version = version
+        except Exception:
+            self._lock.release()
+            raise
+
+    def end(self, commit=True):
+        try:
+            self._conn.execute("COMMIT" if commit else "ROLLBACK")
+            if not commit:
+                self.cache.clear()
+            self._sessions += 1
+            if self._sessions % self.PURGE_EVERY == 0:
+                self.purge()
+        finally:
+            self._lock.release()
+
+    def get_many(self, items):
+        found = self.cache.get_many(items)
+        missing = [item for item in items if item not in found]
+        if missing:
+            now = time.time()
+            cutoff = now - self.ttl
+            loaded = {}
+            ages = {}
+            # One query per namespace; chunked to stay under SQLite's variable limit
+            by_ns = {}
+            for ns, key in missing:
+                by_ns.setdefault(ns, []).append(key)
+            with self._lock:
+                for ns, keys in by_ns.items():
+                    for start in range(0, len(keys), 500):
+                        chunk = keys[start:start + 500]
+                        rows = self._conn.execute(
+                            f"SELECT key, value, updated FROM state WHERE ns = ? AND updated >= ? AND key IN ({','.join('?' * len(chunk))})",
+                            [ns, 0.0 if ns in self.persistent else cutoff, *chunk],
+                        ).fetchall()
+                        for key, value, updated in rows:
+                            loaded[(ns, key)] = value
+                            ages[(ns, key)] = max(0.0, now - updated)
+            self.cache.put_many(loaded, ages)
+            found.update(loaded)
+        return found
+
+    def put_many(self, values):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO state (ns, key, value, updated) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+                [(ns, key, raw, now) for (ns, key), raw in values.items() if raw is not None],
+            )
+            self._conn.executemany(
+                "DELETE FROM state WHERE ns = ? AND key = ?",
+                [(ns, key) for (ns, key), raw in values.items() if raw is None],
+            )
+        self.cache.put_many(values)
+
+    def purge(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            changes = self._conn.total_changes
+            # Owned documents go with their expiring owner: one primary-key
+            # range per owner, the keys that extend the owner's key
+            for ns, owner in self.owned.items():
+                expired = self._conn.execute("SELECT key FROM state WHERE ns = ? AND updated < ?", (owner, cutoff)).fetchall()
+                self._conn.executemany("DELETE FROM state WHERE ns = ? AND key >= ? AND key < ?",
+                                       [(ns, key + "\x1f", key + "\x20") for (key,) in expired])
+            self._conn.execute(
+                f"DELETE FROM state WHERE updated < ? AND ns NOT IN ({','.join('?' * len(self.persistent))})",
+                (cutoff, *sorted(self.persistent)),
+            )
+            # Cached owned documents never expire on their own: drop the cache
+            # when the sweep deleted anything, so purged rows are not served
+            if self._conn.total_changes != changes:
+                self.cache.clear()
+            self.rows = self._count()
+
+    def _count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM state").fetchone()[0]
+
+    def __len__(self):
+        return self.rows
+
+    def stats(self):
+        return {"backend": "sqlite", "path": self.path, "rows": len(self), "ttl_seconds": self.ttl,
+                "cache": self.cache.stats()}
+
+
+def open_state_store(backend="sqlite", path="deepgen_state.sqlite3", max_entries=100_000, ttl_seconds=7 * 24 * 3600.0,
+                     persistent=(), budgets=None, owned=None):
+    if backend == "memory":
+        # The only copy: persistent namespaces are never evicted unless given
+        # a budget. Owned documents outlive an expired owner here until their
+        # budget evicts them.
+        owned = dict(owned or {})
+        budgets = {**{ns: None for ns in persistent}, **(budgets or {})}
+        return MemoryStateStore(max_entries, ttl_seconds, frozenset(persistent) | frozenset(owned), budgets)
+    if backend == "sqlite":
+        return SQLiteStateStore(path, max_entries, ttl_seconds, persistent, budgets, owned)
+    raise ValueError(f"unknown state backend: {backend!r} (expected 'memory' or 'sqlite')")
@@ -0,0 +1,132 @@
+# text_styling.py
+# Slang, accent, tone, subtext, humor, vulnerability and humanizing passes for
+# generated dialogue.
+#
+# Everything that depends only on the (personality, accent, emotion) profile is
+# compiled once into a StyleProfile: all slang and accent substitutions become
+# one KeywordMatcher applied in a single pass, and the fixed suffixes are
+# precomputed. Profiles are memoized in a bounded LRU cache, so styling cost
+# does not grow with the number of rules and is cheap enough for long LSTM
+# output. Only the random flourishes are drawn per call.
+#
+# Substitution rules are data: every *.json file in the rules directory adds
+# {"slang": [[from, to], ...], "accents": {"name": [[from, to], ...]}}. Files
+# load in name order; on conflicting keys slang wins over accents and earlier
+# rules win over later ones.
+import functools
+import glob
+import json
+import os
+import random
+
+from keyword_matcher import KeywordMatcher
+
+RULES_DIR = os.environ.get("DEEPGEN_STYLE_RULES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "style_rules"))
+PROFILE_CACHE_SIZE = int(os.environ.get("DEEPGEN_STYLE_CACHE_SIZE", "1024"))
+
+JOKES = [
+    "Why did the AI cross the road? To optimize the chicken!",
+    "I'm not lazy, I'm just on energy-saving mode.",
+    "I would tell you a joke about UDP, but you might not get it."
+]
+
+TONE_SUFFIXES = {
+    "angry": "!",
+    "sad": "...",
+    "happy": " :)",
+    "afraid": " (voice trembling)",
+}
+
+# Personality words that change styling; anything else in the free-text
+# personality is irrelevant here and must not fragment the profile cache
+PERSONALITY_TRAITS = ("youthful", "sarcastic", "funny", "shy")
+
+
+def load_style_rules(rules_dir=RULES_DIR):
+    rules = {"slang": [], "accents": {}}
+    for path in sorted(glob.glob(os.path.join(rules_dir, "*.json"))):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        rules["slang"].extend(tuple(pair) for pair in data.get("slang", []))
+        for accent, pairs in data.get("accents", {}).items():
+            rules["accents"].setdefault(accent, []).extend(tuple(pair) for pair in pairs)
+    return rules
+
+
+STYLE_RULES = load_style_rules()
+
+
+def personality_traits(personality):
+    if not personality:
+        return frozenset()
+    lowered = personality.lower()
+    # "youthful" was matched case-insensitively, the other traits case-sensitively
+    return frozenset(t for t in PERSONALITY_TRAITS if t in (lowered if t == "youthful" else personality))
+
+
+class StyleProfile:
+    def __init__(self, traits, accent, emotion, rules=None):
+        rules = rules or STYLE_RULES
+        substitutions = {}
+        for k, v in rules["slang"]:
+            substitutions.setdefault(k, v)
+        for k, v in rules["accents"].get(accent, []) if accent else []:
+            substitutions.setdefault(k, v)
+        self.matcher = KeywordMatcher(substitutions)
+        self.slang_suffix = " lol" if "youthful" in traits else ""
+        self.upper = emotion == "angry"
+        # Tone, then subtext
+        suffix = TONE_SUFFIXES.get(emotion, "")
+        if "sarcastic" in traits:
+            suffix += " (but doesn't really mean it)"
+        elif emotion == "sad":
+            suffix += " (trying to hide their true feelings)"
+        self.suffix = suffix
+        self.funny = "funny" in traits
+        vulnerability = ""
+        if emotion == "afraid":
+            vulnerability += " (voice cracks a little)"
+        if "shy" in traits:
+            vulnerability += " (hesitates)"
+        self.vulnerability = vulnerability
+
+    def transform(self, text):
+        # Deterministic part: substitutions, slang suffix, tone case
+        text = self.matcher.sub(text) + self.slang_suffix
+        return text.upper() if self.upper else text
+
+
+@functools.lru_cache(maxsize=PROFILE_CACHE_SIZE)
+def _compiled_profile(traits, accent, emotion):
+    return StyleProfile(traits, accent, emotion)
+
+
+def compile_profile(personality=None, accent=None, emotion=None, traits=None):
+    # `traits` (precomputed personality_traits) skips scanning `personality`
+    return _compiled_profile(personality_traits(personality) if traits is None else traits, accent, emotion)
+
+
+def humanize_dialogue(text, rng=random):
+    if rng.random() < 0.2:
+        text = "... " + text
+    if rng.random() < 0.2:
+        text = text.replace(",", ", um,")
+    if rng.random() < 0.1:
+        text = text + " (pauses)"
+    return text
+
+
+def style_dialogue(text, profile, context=None, rng=random):
+    """Apply the full styling pipeline for a compiled profile."""
+    text = profile.transform(text) + profile.suffix
+    # Contextual reference
+    if context and "Backstory" in context:
+        text += " (remembers their past)"
+    # Wordplay/humor for lightheartedness
+    if profile.funny:
+        text += " " + rng.choice(JOKES)
+    # Vulnerability and imperfection
+    text += profile.vulnerability
+    if rng.random() < 0.1:
+        text += " Sorry, I might be wrong."
+    return humanize_dialogue(text, rng)
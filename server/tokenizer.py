@@ -0,0 +1,97 @@
+# tokenizer.py
+# Lookup-table tokenizers for the LSTM.
+#
+# Whole strings are encoded and decoded in bulk through NumPy tables instead
+# of one dict lookup per character:
+#   CharTokenizer  the model's character vocabulary (lstm_model.VOCAB). Text
+#                  is lowercased and characters outside the vocabulary are
+#                  dropped, as before.
+#   ByteTokenizer  256 symbols, one per UTF-8 byte, so no input is lost. A
+#                  checkpoint trained on it records BYTE_VOCAB as its vocab.
+#
+# encode(text, max_tokens) keeps only the trailing max_tokens tokens and only
+# converts the tail of the text it needs, so the cost of encoding (and of the
+# prefill it feeds) stays bounded however long the prompt is.
+import codecs
+
+import numpy as np
+
+from lstm_model import VOCAB
+
+TOKENIZERS = ("char", "byte")
+BYTE_VOCAB = "".join(map(chr, range(256)))
+
+
+class CharTokenizer:
+    name = "char"
+
+    def __init__(self, vocab=VOCAB):
+        self.vocab = "".join(vocab)
+        self.size = len(self.vocab)
+        # codepoint -> index (-1 outside the vocabulary) and index -> codepoint
+        codepoints = np.array([ord(c) for c in self.vocab], dtype=np.uint32)
+        self._encode_table = np.full(int(codepoints.max()) + 1, -1, dtype=np.int64)
+        self._encode_table[codepoints] = np.arange(self.size)
+        self._decode_table = codepoints
+
+    def encode(self, text, max_tokens=None):
+        if max_tokens:
+            # Each character yields at most one index: start from the last
+            # max_tokens characters and widen only if too many were dropped
+            span = max_tokens
+            while True:
+                idxs = self.encode_array(text[-span:])
+                if len(idxs) >= max_tokens or span >= len(text):
+                    return idxs[-max_tokens:].tolist()
+                span *= 4
+        return self.encode_array(text).tolist()
+
+    def encode_array(self, text):
+        # All of `text` as an int64 array, for bulk use (e.g. building a corpus)
+        codepoints = np.frombuffer(text.lower().encode("utf-32-le"), dtype=np.uint32)
+        idxs = self._encode_table[codepoints[codepoints < len(self._encode_table)]]
+        return idxs[idxs >= 0]
+
+    def decode(self, idxs):
+        return self._decode_table[np.asarray(idxs, dtype=np.int64)].tobytes().decode("utf-32-le")
+
+    def stream_decoder(self):
+        # idx -> text, for output produced one index at a time
+        return self.vocab.__getitem__
+
+
+class ByteTokenizer:
+    name = "byte"
+    vocab = BYTE_VOCAB
+    size = 256
+
+    def encode(self, text, max_tokens=None):
+        if max_tokens:
+            # Every character is at least one byte
+            data = text[-max_tokens:].encode("utf-8")[-max_tokens:]
+            # Don't start on the continuation bytes of a cut character
+            start = 0
+            while start < len(data) and data[start] & 0xC0 == 0x80:
+                start += 1
+            return list(data[start:])
+        return list(text.encode("utf-8"))
+
+    def encode_array(self, text):
+        return np.frombuffer(text.encode("utf-8"), dtype=np.uint8).astype(np.int64)
+
+    def decode(self, idxs):
+        return np.asarray(idxs, dtype=np.uint8).tobytes().decode("utf-8", errors="replace")
+
+    def stream_decoder(self):
+        # Holds back a partial UTF-8 sequence until its last byte arrives
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        return lambda idx: decoder.decode(bytes((idx,)))
+
+
+def get_tokenizer(name="char"):
+    name = (name or "char").strip().lower()
+    if name == "char":
+        return CharTokenizer()
+    if name == "byte":
+        return ByteTokenizer()
+    raise ValueError(f"unknown tokenizer: {name!r} (expected one of {', '.join(TOKENIZERS)})")
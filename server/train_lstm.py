@@ -0,0 +1,291 @@
+# train_lstm.py
+# Offline training of SimpleLSTM on exported chat messages.
+#
+#   python train_lstm.py messages.jsonl [more.jsonl ...] --out checkpoints/deepgen.pt
+#
+# Input is JSONL, one Message row (see prisma/schema.prisma) per line, e.g.
+#   {"id": 1, "chatId": 7, "sender": "ai", "text": "...", "createdAt": "..."}
+# in chat order. The pipeline never holds the corpus in memory:
+#
+#   1. Tokenize once. The exports are streamed in chunks of lines, encoded by a
+#      pool of processes (one per core) and appended to a flat uint8 token
+#      file next to a small JSON description. A later run over the same exports
+#      and tokenizer reuses the file.
+#   2. Pack. The token file is memory-mapped and cut into batch_size
+#      contiguous lanes; batch i is the i-th seq_len window of every lane, so
+#      row b of consecutive batches continues the same text.
+#   3. Train with truncated BPTT. A DataLoader with several workers slices the
+#      batches out of the map while the model trains on all cores; the hidden
+#      state is carried from one batch to the next and detached, so gradients
+#      flow back at most seq_len steps.
+#   4. Checkpoint every --checkpoint-every steps (written atomically, in the
+#      format the service loads through DEEPGEN_CHECKPOINT) together with the
+#      optimizer state, so --resume continues where training stopped.
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+from lstm_model import SimpleLSTM, save_checkpoint
+from tokenizer import get_tokenizer
+
+CHUNK_LINES = 20_000  # JSONL lines per tokenization task
+
+
+# --- 1. Tokenize once into a memory-mapped token file ---
+_worker_tokenizer = None
+
+
+def _init_tokenizer(name):
+    global _worker_tokenizer
+    _worker_tokenizer = get_tokenizer(name)
+
+
+def _encode_lines(lines, field, sender):
+    # One chunk of JSONL lines -> uint8 tokens, each message ended by a newline
+    texts = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        text = record.get(field)
+        if not isinstance(text, str) or (sender and record.get("sender") != sender):
+            continue
+        texts.append(text)
+        texts.append("\n")
+    return _worker_tokenizer.encode_array("".join(texts)).astype(np.uint8).tobytes()
+
+
+def read_chunks(paths, lines_per_chunk=CHUNK_LINES):
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            chunk = []
+            for line in f:
+                chunk.append(line)
+                if len(chunk) >= lines_per_chunk:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+
+def source_signature(paths):
+    return [[os.path.abspath(p), os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths]
+
+
+def build_token_file(paths, out_path, tokenizer, field="text", sender=None, workers=None):
+    """Tokenize the JSONL exports into `out_path` (uint8 tokens) unless an
+    up-to-date token file is already there. Returns its description."""
+    if tokenizer.size > 256:
+        raise ValueError("the token file stores uint8 tokens; the vocabulary has more than 256 symbols")
+    meta_path = out_path + ".json"
+    wanted = {"vocab": tokenizer.vocab, "field": field, "sender": sender, "sources": source_signature(paths)}
+    if os.path.exists(out_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if all(meta.get(k) == v for k, v in wanted.items()) and os.path.getsize(out_path) == meta["tokens"]:
+            return meta
+
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    tokens = 0
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path + ".tmp", "wb") as out, \
+            ProcessPoolExecutor(workers, initializer=_init_tokenizer, initargs=(tokenizer.name,)) as pool:
+        # At most 2 chunks per worker in flight, so memory stays bounded
+        pending = []
+        for chunk in read_chunks(paths):
+            pending.append(pool.submit(_encode_lines, chunk, field, sender))
+            if len(pending) >= 2 * workers:
+                tokens += out.write(pending.pop(0).result())
+        for future in pending:
+            tokens += out.write(future.result())
+    os.replace(out_path + ".tmp", out_path)
+    meta = {**wanted, "tokens": tokens}
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    print(f"tokenized {tokens:,} tokens in {time.perf_counter() - started:.1f}s with {workers} processes",
+          file=sys.stderr)
+    return meta
+
+
+# --- 2. Packed sequences for truncated BPTT ---
+class PackedSequences(IterableDataset):
+    """Batches [batch_size, seq_len + 1] of tokens[offset:offset + length].
+    The span is cut into batch_size contiguous lanes and batch i holds the i-th
+    seq_len window of every lane (plus the next token as the last target).
+    DataLoader workers take every num_workers-th batch and the loader returns
+    them in order, so batches still arrive in sequence."""
+
+    def __init__(self, path, batch_size, seq_len, offset=0, length=None, start=0):
+        self.path = path
+        self.batch_size = batch_size
+        self.seq_len = seq_len
+        self.offset = offset
+        total = os.path.getsize(path) - offset
+        self.length = total if length is None else min(length, total)
+        self.lane = (self.length - 1) // batch_size
+        self.steps = self.lane // seq_len
+        self.start = start
+
+    def __len__(self):
+        return max(0, self.steps - self.start)
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info else (0, 1)
+        tokens = np.memmap(self.path, dtype=np.uint8, mode="r")
+        starts = self.offset + np.arange(self.batch_size) * self.lane
+        for step in range(self.start + worker, self.steps, workers):
+            base = starts + step * self.seq_len
+            batch = np.stack([tokens[b:b + self.seq_len + 1] for b in base])
+            yield torch.from_numpy(batch.astype(np.int64))
+
+
+# --- 3. Truncated BPTT training ---
+def detach(hidden):
+    return None if hidden is None else tuple(h.detach() for h in hidden)
+
+
+def batch_loss(model, batch, hidden):
+    inputs, targets = batch[:, :-1], batch[:, 1:]
+    logits, hidden = model(inputs, hidden)
+    return F.cross_entropy(logits.reshape(-1, logits.shape[-1]), targets.reshape(-1)), hidden
+
+
+def evaluate(model, dataset, max_batches):
+    # Mean loss (nats/token) over the first max_batches held-out batches
+    model.eval()
+    total, count, hidden = 0.0, 0, None
+    with torch.inference_mode():
+        for batch in dataset:
+            loss, hidden = batch_loss(model, batch, hidden)
+            total += loss.item()
+            count += 1
+            if count >= max_batches:
+                break
+    model.train()
+    return total / count if count else float("nan")
+
+
+def save(model, optimizer, path, vocab, step, epoch, args):
+    # Written to a temporary file first, so a service loading the checkpoint
+    # never sees it half-written
+    tmp = path + ".tmp"
+    save_checkpoint(model, tmp, vocab, step=step, epoch=epoch, optimizer=optimizer.state_dict(),
+                    train_config={"seq_len": args.seq_len, "batch_size": args.batch_size, "lr": args.lr})
+    os.replace(tmp, path)
+
+
+def train(args):
+    threads = args.threads or os.cpu_count() or 1
+    torch.set_num_threads(threads)
+    torch.manual_seed(args.seed)
+    tokenizer = get_tokenizer(args.tokenizer)
+    token_path = args.tokens or os.path.splitext(args.out)[0] + ".tokens"
+    meta = build_token_file(args.inputs, token_path, tokenizer, args.field, args.sender, args.tokenize_workers)
+
+    # The last val_fraction of the corpus is held out
+    val_tokens = int(meta["tokens"] * args.val_fraction)
+    train_tokens = meta["tokens"] - val_tokens
+    steps_per_epoch = PackedSequences(token_path, args.batch_size, args.seq_len, length=train_tokens).steps
+    if steps_per_epoch < 1:
+        raise SystemExit(f"{meta['tokens']:,} tokens are too few for batch size {args.batch_size} x seq len {args.seq_len}")
+    total_steps = args.steps or args.epochs * steps_per_epoch
+
+    model = SimpleLSTM(tokenizer.size, args.hidden_size, args.layers)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    step = 0
+    if args.resume and os.path.exists(args.out):
+        checkpoint = torch.load(args.out, map_location="cpu", weights_only=True)
+        if checkpoint["config"]["vocab"] != tokenizer.vocab:
+            raise SystemExit(f"{args.out} was trained with a different tokenizer")
+        model = SimpleLSTM(tokenizer.size, checkpoint["config"]["hidden_size"], checkpoint["config"]["num_layers"])
+        model.load_state_dict(checkpoint["state_dict"])
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        step = checkpoint.get("step", 0)
+        print(f"resuming {args.out} at step {step}", file=sys.stderr)
+    model.train()
+
+    print(f"{train_tokens:,} training tokens, {steps_per_epoch:,} steps/epoch, {total_steps:,} steps, "
+          f"{threads} threads, {args.loader_workers} loader workers", file=sys.stderr)
+    started, window_started, window_loss, window_steps = time.perf_counter(), time.perf_counter(), 0.0, 0
+    while step < total_steps:
+        epoch, start = divmod(step, steps_per_epoch)
+        data = PackedSequences(token_path, args.batch_size, args.seq_len, length=train_tokens, start=start)
+        loader = DataLoader(data, batch_size=None, num_workers=args.loader_workers,
+                            prefetch_factor=4 if args.loader_workers else None)
+        hidden = None  # a new epoch (or a resumed one) starts from a zero state
+        for batch in loader:
+            loss, hidden = batch_loss(model, batch, hidden)
+            hidden = detach(hidden)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+            optimizer.step()
+            step += 1
+            window_loss += loss.item()
+            window_steps += 1
+
+            if step % args.log_every == 0 or step == total_steps:
+                elapsed = time.perf_counter() - window_started
+                rate = window_steps * args.batch_size * args.seq_len / elapsed
+                print(f"step {step:,}/{total_steps:,} epoch {epoch} loss {window_loss / window_steps:.4f} "
+                      f"({window_loss / window_steps / math.log(2):.3f} bits/token) {rate:,.0f} tokens/s",
+                      file=sys.stderr)
+                window_started, window_loss, window_steps = time.perf_counter(), 0.0, 0
+            if step % args.checkpoint_every == 0 or step == total_steps:
+                if val_tokens > args.batch_size * (args.seq_len + 1):
+                    val = PackedSequences(token_path, args.batch_size, args.seq_len, offset=train_tokens)
+                    print(f"step {step:,} validation loss {evaluate(model, val, args.eval_batches):.4f}", file=sys.stderr)
+                save(model, optimizer, args.out, tokenizer.vocab, step, epoch, args)
+            if step >= total_steps:
+                break
+    print(f"trained {step:,} steps in {time.perf_counter() - started:.1f}s; checkpoint at {args.out}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python train_lstm.py", description="Train SimpleLSTM on JSONL message exports")
+    parser.add_argument("inputs", nargs="+", help="JSONL exports of the Message table")
+    parser.add_argument("--out", default="checkpoints/deepgen.pt", help="checkpoint to write (and --resume from)")
+    parser.add_argument("--tokens", help="token file (default: next to --out)")
+    parser.add_argument("--tokenizer", choices=["char", "byte"], default=os.environ.get("DEEPGEN_TOKENIZER", "char"))
+    parser.add_argument("--field", default="text", help="JSON field holding the message text")
+    parser.add_argument("--sender", help="only train on messages from this sender, e.g. 'ai'")
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--layers", type=int, default=1)
+    parser.add_argument("--seq-len", type=int, default=128, help="truncated BPTT window")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--steps", type=int, help="stop after this many steps instead of --epochs")
+    parser.add_argument("--lr", type=float, default=2e-3)
+    parser.add_argument("--clip", type=float, default=1.0, help="gradient norm clip")
+    parser.add_argument("--val-fraction", type=float, default=0.01)
+    parser.add_argument("--eval-batches", type=int, default=20)
+    parser.add_argument("--checkpoint-every", type=int, default=500)
+    parser.add_argument("--log-every", type=int, default=50)
+    parser.add_argument("--threads", type=int, help="torch threads (default: all cores)")
+    parser.add_argument("--tokenize-workers", type=int, help="tokenizer processes (default: all cores)")
+    parser.add_argument("--loader-workers", type=int, default=min(2, os.cpu_count() or 1))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--resume", action="store_true")
+    args = parser.parse_args(argv)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    train(args)
+
+
+if __name__ == "__main__":
+    main()